@@ -1,27 +1,61 @@
 # change working directory to src/visualization
 import os
 os.chdir('src/visualization') # allow for local run via bokeh serve
-print(os.getcwd())
 
 # import tab capability bokeh
 from bokeh.io import curdoc
+from bokeh.models import Div
 from bokeh.models.widgets import Panel, Tabs
 
-# update the DB to include new data if available
-from src.data.process_data import update_db
-update_db()
+# update the DB in the background, not blocking the dashboard (once per process)
+from src.data.refresh_db import refresher
+refresher.start()
 
 # import the dashboard pages/tabs
 from src.visualization.growth_dashboard import growth_tab
 from src.visualization.country_dashboard import country_tab
 
-# create the tabls
-country_tab = Panel(child = country_tab(), title = 'Countries')
-growth_tab = Panel(child = growth_tab(), title = 'Growth')
+# slider & animation in the browser (COVID_CLIENT_ANIMATION=1) or via the server
+client_animation = os.environ.get('COVID_CLIENT_ANIMATION', '0') == '1'
 
-# combine to final output
-tabs = Tabs(tabs=[country_tab, growth_tab])
+# create the tabls: a placeholder until a tab is first opened, such that a
+# session only builds (queries & prepares) the tabs the user looks at
+tab_builders = {'Countries' : country_tab, 'Growth' : growth_tab}
+tabs = Tabs(tabs = [Panel(child = Div(text = 'Loading ...'), title = title) for title in tab_builders])
+built = set()
+
+def build_tab(index):
+    panel = tabs.tabs[index]
+    panel.child = tab_builders[panel.title](client_animation)
+    built.add(index)
+
+def on_tab_change(attr, old, new):
+    if new not in built:
+        build_tab(new)
+
+tabs.on_change('active', on_tab_change)
+build_tab(tabs.active)
+
+#### pick up new data from the refresher
+doc = curdoc()
+
+def refresh_tabs():
+    # only the tabs built so far, the others are built with the new data when opened
+    for index in list(built):
+        build_tab(index)
+
+# called from the refresher thread, update the document on the next tick
+def on_new_data():
+    doc.add_next_tick_callback(refresh_tabs)
+
+refresher.add_listener(on_new_data)
+
+# bokeh clears the globals of this script when the session ends, bind what is needed
+def on_session_destroyed(session_context, remove_listener = refresher.remove_listener, listener = on_new_data):
+    remove_listener(listener)
+
+doc.on_session_destroyed(on_session_destroyed)
 
 #### output
-curdoc().add_root(tabs)
-curdoc().title = 'Covid-19'
+doc.add_root(tabs)
+doc.title = 'Covid-19'
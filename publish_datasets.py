@@ -0,0 +1,21 @@
+# loader process of a multi-process deployment: keeps the DB up-to-date and
+# publishes the dashboard datasets (memory-mapped, read-only) to the workers
+#   python publish_datasets.py &
+#   COVID_SHARED_DATASETS=1 bokeh serve main_dashboard.py --num-procs 4
+import os
+import threading
+
+from src.data.refresh_db import DBRefresher
+from src.data.shared_datasets import shared
+from src.visualization.dashboard_data import store
+
+# the single process updating the DB
+refresher = DBRefresher(interval = int(os.environ.get('COVID_REFRESH_INTERVAL', 3600)),
+                        revise_days = int(os.environ.get('COVID_REVISE_DAYS', 14)))
+refresher.start()
+
+# publish a new version whenever the data changes, new or revised dates (and once at start)
+refresher.add_listener(lambda: store.publish(shared))
+store.publish(shared)
+
+threading.Event().wait()
@@ -0,0 +1,411 @@
+"""
+Load test a dashboard worker: open N concurrent sessions against a
+(local) `bokeh serve main_dashboard.py` and drive the date slider, Play
+animation and map taps, as users would.
+
+Reports per action the client-side latency (request to server reply, i.e.
+incl. the python callback), the websocket bytes received per session, the
+session creation latency and the resident memory of the server per
+session (once all tabs are opened). With --start-server the server is
+started with COVID_PROFILE=1, such that its own metrics (callback latency
+& patch bytes) are added, on a copy of the DB without the refresher (no
+downloads or DB updates during the test).
+
+Run from the root of the repository:
+    python -m src.benchmark.load_test --start-server --sessions 10
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+from bokeh.client import ClientSession
+from bokeh.client.util import websocket_url_for_server_url
+from bokeh.document.events import MessageSentEvent
+from bokeh.models import DateSlider, Button, ColumnDataSource, Div, Tabs
+from bokeh.protocol import Protocol
+
+root_folder = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..')) + '/'
+results_folder = root_folder + 'reports/load_tests/'
+
+data_events = ['ColumnDataChanged', 'ColumnsPatched', 'ColumnsStreamed']
+
+
+def resident_memory(pid):
+    """
+    Resident memory (RSS) of a process in MB, read from /proc (linux only)
+
+    Returns:
+    MB (float), None if not available
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def copy_db(folder):
+    """
+    Copy the covid DB into folder, with daily_stats complete (the sessions
+    read it, the refresher is disabled during the test)
+
+    Returns:
+    path of the copy
+    """
+    path = os.path.join(folder, 'covid_db.sqlite')
+    shutil.copy(root_folder + 'data/processed/covid_db.sqlite', path)
+    subprocess.run([sys.executable, '-c', 'from src.data.process_data import update_daily_stats; update_daily_stats()'],
+                   cwd = root_folder, env = dict(os.environ, COVID_DB = path), check = True,
+                   stdout = subprocess.DEVNULL)
+    return path
+
+
+def start_server(port, metrics_port, db_file, timeout = 120):
+    """
+    Start `bokeh serve main_dashboard.py` with metrics enabled on a copy of
+    the DB, without the refresher, and wait until it accepts requests
+
+    Parameters:
+    port (int): port of the dashboard
+    metrics_port (int): port of the metrics endpoint
+    db_file (string): DB to serve (a copy, see copy_db)
+    timeout (int): seconds to wait for the server
+
+    Returns:
+    the server process (subprocess.Popen)
+    """
+    env = dict(os.environ, COVID_PROFILE = '1', COVID_PROFILE_PORT = str(metrics_port),
+               COVID_DB = db_file, COVID_REFRESH = '0')
+    process = subprocess.Popen([sys.executable, '-m', 'bokeh', 'serve', 'main_dashboard.py',
+                                '--port', str(port), '--allow-websocket-origin', 'localhost:{}'.format(port)],
+                               cwd = root_folder, env = env,
+                               stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+    start = time.time()
+    while time.time() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError('bokeh serve exited with code {}'.format(process.returncode))
+        try:
+            # a static file: a request to the app would create a session
+            urllib.request.urlopen('http://localhost:{}/static/js/bokeh.min.js'.format(port), timeout = 5)
+            return process
+        except OSError:
+            time.sleep(0.5)
+
+    process.terminate()
+    raise RuntimeError('bokeh serve did not start within {}s'.format(timeout))
+
+
+class LoadSession:
+    """
+    One simulated user: a bokeh client session on the dashboard, with the
+    websocket bytes it receives counted
+
+    Parameters:
+    url (string): url of the dashboard
+    """
+    def __init__(self, url):
+        start = time.perf_counter()
+        self.session = ClientSession(websocket_url = websocket_url_for_server_url(url))
+        self.session.connect()
+        self.connection = self.session._connection
+
+        # count the bytes read from the websocket, incl. the initial document
+        self.bytes_received = 0
+        socket = self.connection._socket
+        read_message = socket.read_message
+        async def counting_read_message(*args, **kwargs):
+            fragment = await read_message(*args, **kwargs)
+            self.bytes_received += len(fragment) if fragment is not None else 0
+            return fragment
+        socket.read_message = counting_read_message
+
+        # data changes are counted, not applied: the python client can't apply
+        # all of them (i.e. partial data updates & binary columns) as the
+        # browser does, and the simulated user doesn't look at the data
+        handle_patch = self.session._handle_patch
+        def handle_patch_without_data(message):
+            message.content['events'] = [event for event in message.content['events']
+                                         if event['kind'] not in data_events and event.get('attr') != 'data']
+            # incl. the data of new models, i.e. a tab built on first activation
+            for reference in message.content.get('references', []):
+                reference['attributes'].pop('data', None)
+            handle_patch(message)
+        self.session._handle_patch = handle_patch_without_data
+
+        self.session.pull()
+        self.create_seconds = time.perf_counter() - start
+
+        # the tabs are built on first activation, the first one at session creation
+        self.tabs = self.session.document.select_one({'type' : Tabs})
+        self.geosource = [m for m in self.session.document.select({'type' : ColumnDataSource})
+                          if 'xs' in m.data][0]
+        self.latencies = {}
+
+
+    def open_tab(self, index):
+        """
+        Activate a tab (building it on the server when first opened)
+
+        Returns:
+        dictionary with the slider & play button of the tab
+        """
+        panel = self.tabs.tabs[index]
+        if self.tabs.active != index:
+            # wait for the new child (not a roundtrip: the client ignores patches while awaiting a reply)
+            start, placeholder = time.perf_counter(), panel.child
+            self.tabs.active = index
+            if isinstance(placeholder, Div):
+                self.connection._loop_until(lambda: panel.child is not placeholder)
+            self.latencies.setdefault('open_tab', []).append((time.perf_counter() - start) * 1000)
+
+        models = panel.child.references()
+        return {'slider' : [m for m in models if isinstance(m, DateSlider)][0],
+                'button' : [m for m in models if isinstance(m, Button)][0]}
+
+
+    def roundtrip(self, action, change):
+        """
+        Make a change and wait for the server to reply: messages of a session
+        are handled in order, so the reply follows the callbacks of the change
+
+        Parameters:
+        action (string): name to record the latency under
+        change (function): function without arguments changing the document
+        """
+        start = time.perf_counter()
+        change()
+        self.connection.force_roundtrip()
+        self.latencies.setdefault(action, []).append((time.perf_counter() - start) * 1000)
+
+
+    def click(self, button):
+        """
+        Send a click on a button to the server (the bokeh client only sends
+        property changes, events are send as the browser does)
+        """
+        event = MessageSentEvent(self.session.document, 'bokeh_event',
+                                 {'event_name' : 'button_click',
+                                  'event_values' : {'model' : {'id' : button.id}}})
+        message = Protocol().create('PATCH-DOC', [event])
+        self.connection._loop.add_callback(self.connection.send_message, message)
+
+
+    def wait(self, seconds):
+        """
+        Keep receiving (i.e. animation frames) for a number of seconds
+        """
+        end = time.perf_counter() + seconds
+        self.connection._loop_until(lambda: time.perf_counter() > end)
+
+
+    def close(self):
+        self.session.close()
+
+
+def drive_session(url, ticks, taps, play_seconds, result, ready, go, opened, resume):
+    """
+    Script of one user: open the dashboard and all tabs, move the slider of
+    each tab, tap countries on the map and run the animation. Waits (ready,
+    opened) for the other sessions after creating the session and after
+    opening the tabs, until the go & resume events are set.
+    """
+    try:
+        load = LoadSession(url)
+        result['create_seconds'] = load.create_seconds
+        result['bytes_initial'] = load.bytes_received
+        ready.set()
+        go.wait()
+
+        tabs = [load.open_tab(index) for index in range(len(load.tabs.tabs))]
+        opened.set()
+        resume.wait()
+
+        rng = np.random.default_rng()
+        for tab in tabs:
+            slider = tab['slider']
+            end = datetime.fromtimestamp(slider.end / 1000) if isinstance(slider.end, (int, float)) else slider.end
+            for i in range(ticks):
+                value = end - timedelta(days = int(rng.integers(0, 100)))
+                load.roundtrip('slider', lambda: setattr(slider, 'value', value))
+
+        n_countries = len(load.geosource.data['country'])
+        for i in range(taps):
+            indx = int(rng.integers(0, n_countries))
+            load.roundtrip('tap', lambda: setattr(load.geosource.selected, 'indices', [indx]))
+
+        if play_seconds > 0:
+            for index, tab in enumerate(tabs):
+                load.open_tab(index)
+                load.roundtrip('play', lambda: load.click(tab['button']))
+                load.wait(play_seconds)
+                load.roundtrip('pause', lambda: load.click(tab['button']))
+
+        result['latencies'] = load.latencies
+        result['bytes_received'] = load.bytes_received
+        load.close()
+
+    except Exception as e:
+        result['error'] = repr(e)
+        ready.set()
+        opened.set()
+
+
+def run(url, n_sessions = 10, ticks = 20, taps = 5, play_seconds = 5, server_pid = None, metrics_url = None):
+    """
+    Open n_sessions concurrent sessions and drive them
+
+    Parameters:
+    url (string): url of the dashboard
+    n_sessions (int): number of concurrent sessions
+    ticks (int): slider moves per tab per session
+    taps (int): map taps per session
+    play_seconds (int): seconds of animation per tab per session
+    server_pid (int): pid of the server, for the memory per session
+    metrics_url (string): metrics endpoint of the server (COVID_PROFILE_PORT)
+
+    Returns:
+    dictionary with the settings, the summary and the server metrics
+    """
+    rss_before = resident_memory(server_pid) if server_pid else None
+
+    results = [{} for _ in range(n_sessions)]
+    ready = [threading.Event() for _ in range(n_sessions)]
+    opened = [threading.Event() for _ in range(n_sessions)]
+    go, resume = threading.Event(), threading.Event()
+    threads = [threading.Thread(target = drive_session,
+                                args = (url, ticks, taps, play_seconds, results[i], ready[i], go, opened[i], resume))
+               for i in range(n_sessions)]
+
+    # all sessions are created concurrently, then drive them together
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for event in ready:
+        event.wait()
+    create_all = time.perf_counter() - start
+    rss_created = resident_memory(server_pid) if server_pid else None
+
+    # memory once every session has all (lazily built) tabs
+    go.set()
+    for event in opened:
+        event.wait()
+    rss_sessions = resident_memory(server_pid) if server_pid else None
+
+    start = time.perf_counter()
+    resume.set()
+    for thread in threads:
+        thread.join()
+    drive_all = time.perf_counter() - start
+
+    ok = [r for r in results if 'error' not in r]
+    pct = lambda values: {'count' : len(values),
+                          'p50' : float(np.percentile(values, 50)),
+                          'p95' : float(np.percentile(values, 95)),
+                          'p99' : float(np.percentile(values, 99)),
+                          'max' : float(np.max(values))} if len(values) > 0 else None
+
+    latencies = {}
+    for r in ok:
+        for action, values in r['latencies'].items():
+            latencies.setdefault(action, []).extend(values)
+
+    summary = {'sessions' : n_sessions,
+               'errors' : [r['error'] for r in results if 'error' in r],
+               'create_all_seconds' : create_all,
+               'drive_all_seconds' : drive_all,
+               'session_create_ms' : pct([r['create_seconds'] * 1000 for r in ok]),
+               'callback_ms' : {action : pct(values) for action, values in latencies.items()},
+               'bytes_initial_per_session' : pct([r['bytes_initial'] for r in ok]),
+               'bytes_per_session' : pct([r['bytes_received'] for r in ok]),
+               'server_rss_mb' : rss_before,
+               'server_rss_mb_per_session_created' : None if rss_before is None or rss_created is None
+                                                     else (rss_created - rss_before) / n_sessions,
+               'server_rss_mb_per_session' : None if rss_before is None or rss_sessions is None
+                                             else (rss_sessions - rss_before) / n_sessions}
+
+    server_metrics = None
+    if metrics_url:
+        try:
+            server_metrics = json.loads(urllib.request.urlopen(metrics_url, timeout = 10).read())
+        except OSError as e:
+            print('unable to get the server metrics: {}'.format(e))
+
+    return {'settings' : {'url' : url, 'sessions' : n_sessions, 'ticks' : ticks, 'taps' : taps,
+                          'play_seconds' : play_seconds,
+                          'started' : datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
+            'summary' : summary,
+            'server_metrics' : server_metrics}
+
+
+def summary_table(load_test):
+    """
+    Client-side latencies as a table (ms per action)
+    """
+    summary = load_test['summary']
+    rows = {'session_create' : summary['session_create_ms']}
+    rows.update(summary['callback_ms'])
+    return pd.DataFrame({name : values for name, values in rows.items() if values is not None}).T
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Load test a covid dashboard worker with concurrent sessions')
+    parser.add_argument('--url', help = 'url of a running dashboard (default: start one)')
+    parser.add_argument('--pid', type = int, help = 'pid of the running server, for its memory use')
+    parser.add_argument('--metrics-url', help = 'metrics endpoint of the running server')
+    parser.add_argument('--start-server', action = 'store_true', help = 'start bokeh serve main_dashboard.py')
+    parser.add_argument('--sessions', type = int, default = 10)
+    parser.add_argument('--ticks', type = int, default = 20, help = 'slider moves per tab per session')
+    parser.add_argument('--taps', type = int, default = 5, help = 'map taps per session')
+    parser.add_argument('--play', type = float, default = 5, help = 'seconds of animation per tab per session')
+    parser.add_argument('--label', help = 'added to the name of the results file')
+    args = parser.parse_args()
+
+    server, work = None, None
+    if args.start_server or args.url is None:
+        work = tempfile.mkdtemp(prefix = 'covid_load_test_')
+        port, metrics_port = free_port(), free_port()
+        server = start_server(port, metrics_port, copy_db(work))
+        url = 'http://localhost:{}/main_dashboard'.format(port)
+        pid, metrics_url = server.pid, 'http://localhost:{}/metrics'.format(metrics_port)
+    else:
+        url, pid, metrics_url = args.url, args.pid, args.metrics_url
+
+    try:
+        load_test = run(url, args.sessions, args.ticks, args.taps, args.play, pid, metrics_url)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(work, ignore_errors = True)
+
+    print(summary_table(load_test).to_string(float_format = '{:.1f}'.format))
+    print(json.dumps({k : v for k, v in load_test['summary'].items() if k not in ['callback_ms', 'session_create_ms']},
+                     indent = 2))
+
+    os.makedirs(results_folder, exist_ok = True)
+    path = os.path.join(results_folder, '{}_{}s{}.json'.format(datetime.now().strftime('%Y%m%d_%H%M%S'), args.sessions,
+                                                                 '' if args.label is None else '_' + args.label))
+    with open(path, 'w') as f:
+        json.dump(load_test, f, indent = 2)
+    print('saved to ' + path)
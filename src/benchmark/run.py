@@ -0,0 +1,370 @@
+"""
+Benchmark the data & dashboard pipeline on synthetic data of configurable
+size, i.e. to find the scaling limits before the real history grows there.
+
+Run from the root of the repository:
+    python -m src.benchmark.run --countries 400 --provinces 3 --days 2000
+
+Results are saved as json in reports/benchmarks/, compare two runs with:
+    python -m src.benchmark.run --compare <old.json> <new.json>
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import threading
+import subprocess
+import functools
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+
+from src.benchmark.synthetic import synthetic_countries, write_jhu_files, write_db
+from src.data import process_data
+from src.data.process_data import cleanMainDataset, clean_files, download_data, files
+from src.data.artifact_cache import ArtifactCache
+from src.data.process_geometry import load_geometry_tiers, build_geometry_tiers
+from src.visualization import country_dashboard, growth_dashboard
+from src.visualization.dashboard_data import DatasetStore, load_country_data, load_growth_data
+from src.visualization.prepare_dashboard_data import country_plot_data, prep_map_attributes, prep_exp_plot
+from src.visualization.instrument import message_size
+
+from bokeh.document import Document
+from bokeh.models import DateSlider
+from bokeh.util.serialization import convert_datetime_type
+
+results_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../reports/benchmarks/')
+
+
+def measure(func, repeat = 3, check = None):
+    """
+    Time a function
+
+    Parameters:
+    func (function): function without arguments
+    repeat (int): number of runs
+    check (function): called with the result of func, returns False when the
+                      run failed (i.e. an update_db which rolled back)
+
+    Returns:
+    dictionary with the number of runs, min, median & max seconds and
+    whether any of the runs failed
+    """
+    times, failed = [], False
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+        if check is not None and not check(result):
+            failed = True
+
+    return {'runs' : repeat,
+            'min' : float(np.min(times)),
+            'median' : float(np.median(times)),
+            'max' : float(np.max(times)),
+            'failed' : failed}
+
+
+def updated(last_date):
+    """
+    Check of an update_db run: None when the update failed (rolled back)
+    """
+    return last_date is not None
+
+
+def peak_memory(func):
+    """
+    Peak memory (MB) allocated by python & numpy while running a function
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+@contextmanager
+def patched(module, **attrs):
+    """
+    Temporarily replace module attributes, i.e. point update_db to the
+    synthetic DB & files
+    """
+    old = {name : getattr(module, name) for name in attrs}
+    for name, value in attrs.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in old.items():
+            setattr(module, name, value)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def serve_folder(folder):
+    """
+    Serve a folder over http on a free local port (stands in for github,
+    incl. If-Modified-Since / 304 handling)
+
+    Returns:
+    base url of the served folder (string)
+    """
+    handler = functools.partial(QuietHandler, directory = folder)
+    server = ThreadingHTTPServer(('localhost', 0), handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    try:
+        yield 'http://localhost:{}/'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def slider_ticks(layout, dates):
+    """
+    Move the slider of a tab over dates, as a session would
+
+    Parameters:
+    layout: tab (bokeh layout) with a DateSlider
+    dates (list): dates to move the slider to
+
+    Returns:
+    dictionary with the ms per tick and bytes send per tick (mean & max),
+    only the number of ticks when no dates are within the slider range
+    """
+    doc = Document()
+    doc.add_root(layout)
+    slider = [m for m in layout.references() if isinstance(m, DateSlider)][0]
+
+    # dates a user can select (i.e. the growth tab starts later), start & end
+    # may be datetimes or ms since epoch
+    ms = lambda dt: dt if isinstance(dt, (int, float)) else convert_datetime_type(dt)
+    dates = [dt for dt in dates if ms(slider.start) <= ms(dt) <= ms(slider.end)]
+    if len(dates) == 0:
+        return {'ticks' : 0}
+
+    sizes = []
+    doc.on_change(lambda event: sizes.append(message_size(event)))
+
+    times, tick_bytes = [], []
+    for dt in dates:
+        sizes.clear()
+        start = time.perf_counter()
+        slider.value = dt
+        times.append((time.perf_counter() - start) * 1000)
+        tick_bytes.append(sum(sizes))
+
+    return {'ticks' : len(dates),
+            'ms_mean' : float(np.mean(times)),
+            'ms_max' : float(np.max(times)),
+            'bytes_mean' : float(np.mean(tick_bytes)),
+            'bytes_max' : int(np.max(tick_bytes))}
+
+
+def run(n_countries = 185, n_provinces = 2, n_days = 180, new_days = 7, repeat = 3, dashboard = True):
+    """
+    Generate the synthetic data and time each stage
+
+    Parameters:
+    n_countries (int): number of countries
+    n_provinces (int): rows (provinces) per country in the csv files
+    n_days (int): number of days in the csv files
+    new_days (int): days not yet in the DB, added by update_db
+    repeat (int): runs per (repeatable) stage
+    dashboard (bool): also time the tab builds and slider callbacks
+
+    Returns:
+    dictionary with meta data (scale, versions) and the timings (seconds)
+    """
+    work = tempfile.mkdtemp(prefix = 'covid_benchmark_')
+    served, cache = os.path.join(work, 'served'), os.path.join(work, 'raw')
+    os.makedirs(served)
+    os.makedirs(cache)
+    results, sizes = {}, {}
+
+    try:
+        #### synthetic data, real country names first (filled map)
+        start = time.perf_counter()
+        countries = synthetic_countries(n_countries, load_geometry_tiers()['coarse']['country'])
+        frames = write_jhu_files(served, countries, n_provinces, n_days)
+        qdb = write_db(os.path.join(work, 'covid_db.sqlite'), countries, frames, n_days - new_days)
+        generate = time.perf_counter() - start
+        last_date = qdb.output_query("SELECT MAX(date) AS date FROM stats")['date'].iloc[0]
+        sizes['csv_mb'] = sum(os.path.getsize(os.path.join(served, f)) for f in files.values()) / 1e6
+
+        #### cleaning & download
+        confirmed = frames['global_confirmed']
+        results['cleanMainDataset'] = measure(lambda: cleanMainDataset(confirmed, 'confirmed'), repeat)
+
+        # streaming cleaner on the wide files, all dates
+        paths = {metric.split('_')[-1] : os.path.join(served, files[metric]) for metric in files}
+        results['clean_files'] = measure(lambda: clean_files(paths), repeat)
+        sizes['clean_files_peak_mb'] = peak_memory(lambda: clean_files(paths))
+
+        with serve_folder(served) as url:
+            # first download is a full download, after that the files are unchanged (304)
+            results['download_data_full'] = measure(lambda: download_data(last_date, url, cache), 1)
+            results['download_data_unchanged'] = measure(lambda: download_data(last_date, url, cache), repeat)
+
+            # update_db: adds new_days & builds daily_stats from scratch (first run)
+            shutil.rmtree(cache)
+            os.makedirs(cache)
+            with patched(process_data, qdb = qdb, base_url = url, download_folder = cache + '/'):
+                results['update_db'] = measure(process_data.update_db, 1, check = updated)
+                results['update_db_no_new_data'] = measure(process_data.update_db, repeat, check = updated)
+                end_date = qdb.output_query("SELECT MAX(date) AS date FROM daily_stats")['date'].iloc[0]
+
+                # re-ingest the last 30 days (upsert of unchanged rows & daily_stats recompute)
+                revise_from = (pd.Timestamp(end_date) - pd.Timedelta(days = 29)).strftime('%Y-%m-%d')
+                results['update_db_revise_30d'] = measure(lambda: process_data.update_db(revise_from), repeat,
+                                                          check = updated)
+
+        #### queries
+        results['get_coutry_data'] = measure(qdb.get_coutry_data, repeat)
+        results['get_top10_countries'] = measure(qdb.get_top10_countries, repeat)
+        results['get_exp_data'] = measure(qdb.get_exp_data, repeat)
+
+        #### data preparation
+        geometry = load_geometry_tiers()
+        results['build_geometry_tiers'] = measure(lambda: build_geometry_tiers(path = os.path.join(work, 'tiers.npz')), 1)
+        results['load_geometry_tiers'] = measure(load_geometry_tiers, repeat)
+
+        df = qdb.get_coutry_data()
+        results['country_plot_data'] = measure(lambda: country_plot_data(df, geometry['coarse']), repeat)
+        plot_data = country_plot_data(df, geometry['coarse'])
+        dates = plot_data['date'].dt.strftime('%Y-%m-%d').unique()
+        results['prep_map_attributes'] = measure(lambda: [prep_map_attributes(plot_data, geometry['coarse']['country'], dt)
+                                                          for dt in dates], 1)
+
+        exp_data = qdb.get_exp_data()
+        results['prep_exp_plot'] = measure(lambda: prep_exp_plot(exp_data), repeat)
+
+        #### dashboard: tab builds (first incl. loading the data) & slider moves
+        if dashboard:
+            store = DatasetStore(qdb, {'country' : load_country_data, 'growth' : load_growth_data},
+                                 cache = ArtifactCache(os.path.join(work, 'cache')))
+            end = datetime.strptime(str(end_date)[:10], '%Y-%m-%d')
+            # the last (up to) 60 days
+            ticks = [end - timedelta(days = i) for i in range(min(60, n_days))][::-1]
+
+            with patched(country_dashboard, store = store), \
+                 patched(growth_dashboard, store = store):
+                for name, tab in [('country_tab', country_dashboard.country_tab),
+                                  ('growth_tab', growth_dashboard.growth_tab)]:
+                    results[name + '_first'] = measure(tab, 1)
+                    results[name] = measure(tab, repeat)
+                    sizes[name.replace('tab', 'slider')] = slider_ticks(tab(), ticks)
+
+    finally:
+        shutil.rmtree(work, ignore_errors = True)
+
+    return {'meta' : {'countries' : n_countries,
+                      'provinces' : n_provinces,
+                      'days' : n_days,
+                      'new_days' : new_days,
+                      'generate_seconds' : generate,
+                      'started' : datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                      'commit' : git_commit(),
+                      'python' : platform.python_version(),
+                      'pandas' : pd.__version__,
+                      'numpy' : np.__version__},
+            'sizes' : sizes,
+            'results' : results}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def save(benchmark, folder = results_folder, label = None):
+    """
+    Save a benchmark run as json
+
+    Parameters:
+    benchmark (dict): output of run
+    folder (string): folder to save in
+    label (string): added to the file name
+
+    Returns:
+    path of the saved file
+    """
+    os.makedirs(folder, exist_ok = True)
+    meta = benchmark['meta']
+    name = '{}_{}c_{}p_{}d{}.json'.format(datetime.now().strftime('%Y%m%d_%H%M%S'), meta['countries'],
+                                          meta['provinces'], meta['days'],
+                                          '' if label is None else '_' + label)
+    path = os.path.join(folder, name)
+    with open(path, 'w') as f:
+        json.dump(benchmark, f, indent = 2, default = str)
+
+    return path
+
+
+def compare(old, new):
+    """
+    Compare two saved runs: median seconds per stage and the ratio new/old
+
+    Parameters:
+    old (string): json file of the baseline run
+    new (string): json file of the new run
+
+    Returns:
+    pandas dataframe with per stage old, new and ratio
+    """
+    runs = []
+    for path in [old, new]:
+        with open(path) as f:
+            runs.append(pd.Series({stage : r['median'] for stage, r in json.load(f)['results'].items()}))
+
+    table = pd.DataFrame({'old' : runs[0], 'new' : runs[1]})
+    table['ratio'] = table['new'] / table['old']
+    return table
+
+
+def summary(benchmark):
+    """
+    Results of a run as a table (median seconds per stage), incl. whether a
+    stage failed
+    """
+    return pd.DataFrame(benchmark['results']).T[['runs', 'min', 'median', 'max', 'failed']]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the covid data & dashboard pipeline on synthetic data')
+    parser.add_argument('--countries', type = int, default = 185)
+    parser.add_argument('--provinces', type = int, default = 2, help = 'rows per country in the csv files')
+    parser.add_argument('--days', type = int, default = 180)
+    parser.add_argument('--new-days', type = int, default = 7, help = 'days added by update_db')
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--no-dashboard', action = 'store_true', help = 'skip the tab & slider benchmarks')
+    parser.add_argument('--label', help = 'added to the name of the results file')
+    parser.add_argument('--compare', nargs = 2, metavar = ('OLD', 'NEW'), help = 'compare two saved runs')
+    args = parser.parse_args()
+
+    if args.compare:
+        print(compare(*args.compare).to_string(float_format = '{:.3f}'.format))
+        sys.exit(0)
+
+    benchmark = run(args.countries, args.provinces, args.days, args.new_days, args.repeat,
+                    dashboard = not args.no_dashboard)
+    print(summary(benchmark).to_string(float_format = '{:.3f}'.format))
+    print(json.dumps(benchmark['sizes'], indent = 2))
+    print('saved to ' + save(benchmark, label = args.label))
+
+    sys.exit(1 if any(r.get('failed') for r in benchmark['results'].values()) else 0)
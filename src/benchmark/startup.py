@@ -0,0 +1,164 @@
+"""
+Startup time of the dashboard: the import of each module and the first
+build of each tab, every run in a fresh interpreter (as a new worker
+process). Stages over their budget are flagged (exit code 1), such that a
+slow import creeping in shows up.
+
+Run from the root of the repository:
+    python -m src.benchmark.startup
+
+Results are saved as json in reports/benchmarks/.
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from src.benchmark.load_test import copy_db
+
+root_folder = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../'))
+results_folder = os.path.join(root_folder, 'reports/benchmarks/')
+
+# startup budget: seconds per stage (median of the runs)
+budget = {'import_quick_queries' : 0.8,
+          'import_process_data' : 0.8,
+          'import_process_geometry' : 0.3,
+          'import_dashboard_data' : 1.0,
+          'import_country_dashboard' : 1.2,
+          'import_growth_dashboard' : 1.2,
+          'first_country_tab' : 1.5,
+          'first_growth_tab' : 1.5}
+
+# heavy packages which should only be imported when needed
+heavy_modules = ['geopandas', 'shapely', 'sqlalchemy', 'bokeh.models']
+
+# stage: module to import and the code to time after the import
+stages = {'import_quick_queries' : ('src.data.quick_queries', None),
+          'import_process_data' : ('src.data.process_data', None),
+          'import_process_geometry' : ('src.data.process_geometry', None),
+          'import_dashboard_data' : ('src.visualization.dashboard_data', None),
+          'import_country_dashboard' : ('src.visualization.country_dashboard', None),
+          'import_growth_dashboard' : ('src.visualization.growth_dashboard', None),
+          'first_country_tab' : ('src.visualization.country_dashboard', 'country_tab()'),
+          'first_growth_tab' : ('src.visualization.growth_dashboard', 'growth_tab()')}
+
+# run in the fresh interpreter: time the import (or the code after it), report as json
+script = """
+import sys, time, json
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+from {module} import *
+seconds = time.perf_counter() - start
+if {code!r} is not None:
+    start = time.perf_counter()
+    exec({code!r})
+    seconds = time.perf_counter() - start
+print(json.dumps({{'seconds' : seconds,
+                  'modules' : len(sys.modules),
+                  'heavy' : [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def run_stage(module, code = None, db_file = None):
+    """
+    Time the import of a module, or code run after importing it, in a fresh
+    interpreter started in src/visualization (as bokeh serve does)
+
+    Parameters:
+    module (string): module to import
+    code (string): code to time after the import, None to time the import
+    db_file (string): DB to use (COVID_DB), default the covid DB
+
+    Returns:
+    dictionary with the seconds, the number of modules loaded and the heavy
+    modules loaded
+    """
+    source = script.format(root = root_folder, module = module, code = code, heavy = heavy_modules)
+    env = dict(os.environ) if db_file is None else dict(os.environ, COVID_DB = db_file)
+    process = subprocess.run([sys.executable, '-c', source], cwd = os.path.join(root_folder, 'src/visualization'),
+                             env = env, capture_output = True, text = True)
+    if process.returncode != 0:
+        raise RuntimeError('{} failed:\n{}'.format(module if code is None else code, process.stderr))
+
+    # the last line: prints of the modules go before it
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def run(repeat = 3):
+    """
+    Run every stage repeat times
+
+    Parameters:
+    repeat (int): runs per stage
+
+    Returns:
+    dictionary with meta data and per stage the timings (seconds), the
+    budget and the heavy modules loaded
+    """
+    # a copy of the DB with daily_stats complete (the tabs read it)
+    work = tempfile.mkdtemp(prefix = 'covid_startup_')
+    try:
+        db_file = copy_db(work)
+        results = {}
+        for stage, (module, code) in stages.items():
+            runs = [run_stage(module, code, db_file) for _ in range(repeat)]
+            times = [r['seconds'] for r in runs]
+            results[stage] = {'runs' : repeat,
+                              'min' : float(np.min(times)),
+                              'median' : float(np.median(times)),
+                              'max' : float(np.max(times)),
+                              'budget' : budget.get(stage),
+                              'over_budget' : stage in budget and float(np.median(times)) > budget[stage],
+                              'modules' : runs[-1]['modules'],
+                              'heavy' : runs[-1]['heavy']}
+    finally:
+        shutil.rmtree(work, ignore_errors = True)
+
+    return {'meta' : {'started' : datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                      'commit' : git_commit(),
+                      'python' : platform.python_version()},
+            'results' : results}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = root_folder,
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def summary(startup):
+    """
+    Results of a run as a table (seconds per stage)
+    """
+    table = pd.DataFrame(startup['results']).T
+    table['heavy'] = table['heavy'].map(', '.join)
+    return table[['median', 'max', 'budget', 'over_budget', 'modules', 'heavy']]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Startup time of the covid dashboard modules & tabs')
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--label', help = 'added to the name of the results file')
+    args = parser.parse_args()
+
+    startup = run(args.repeat)
+    print(summary(startup).to_string(float_format = '{:.3f}'.format))
+
+    os.makedirs(results_folder, exist_ok = True)
+    path = os.path.join(results_folder, '{}_startup{}.json'.format(datetime.now().strftime('%Y%m%d_%H%M%S'),
+                                                                    '' if args.label is None else '_' + args.label))
+    with open(path, 'w') as f:
+        json.dump(startup, f, indent = 2)
+    print('saved to ' + path)
+
+    sys.exit(1 if any(r['over_budget'] for r in startup['results'].values()) else 0)
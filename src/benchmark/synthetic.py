@@ -0,0 +1,165 @@
+"""
+Synthetic, JHU-shaped data at configurable scale: wide csv files (one row
+per country/province, one column per date) and a covid DB with the stats &
+populations tables, holding all but the last days of the csv files (the
+days left for update_db).
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+from src.data.quick_queries import queryDB
+from src.data.process_data import cleanMainDataset, files
+
+continents = ['Africa', 'Asia', 'Europe', 'North America', 'Oceania', 'South America']
+
+
+def synthetic_countries(n_countries, names = None):
+    """
+    Country names & continents. Real names first (i.e. the countries on the
+    map, such that the choropleth is filled), numbered names after that.
+
+    Parameters:
+    n_countries (int): number of countries
+    names (list): real country names to start with
+
+    Returns:
+    pandas dataframe with columns country & continent
+    """
+    # skip the countries cleanMainDataset removes
+    names = [n for n in (names or []) if n not in ['Diamond Princess','MS Zaandam','Kosovo']][:n_countries]
+    names += ['Country {:05d}'.format(i) for i in range(n_countries - len(names))]
+
+    return pd.DataFrame({'country' : names,
+                         'continent' : [continents[i % len(continents)] for i in range(n_countries)]})
+
+
+def synthetic_cases(n_rows, n_days, seed = 0):
+    """
+    Cumulative confirmed, deaths & recovered per row (country/province) and
+    day, following a logistic curve with random size, speed and start
+
+    Parameters:
+    n_rows (int): number of rows (countries x provinces)
+    n_days (int): number of days
+    seed (int): random seed
+
+    Returns:
+    dictionary with per metric (confirmed, deaths, recovered) an integer
+    numpy array of n_rows x n_days
+    """
+    rng = np.random.default_rng(seed)
+    size = rng.lognormal(9, 2, n_rows)[:, None]
+    speed = rng.uniform(0.03, 0.2, n_rows)[:, None]
+    start = rng.uniform(0, n_days, n_rows)[:, None]
+    days = np.arange(n_days)[None, :]
+
+    confirmed = np.floor(size / (1 + np.exp(-speed * (days - start)))).astype('int64')
+    deaths = np.floor(confirmed * rng.uniform(0.005, 0.1, n_rows)[:, None]).astype('int64')
+
+    # recovered: share of the cases of 2 weeks ago
+    recovered = np.zeros_like(confirmed)
+    recovered[:, 14:] = np.floor(confirmed[:, :-14] * rng.uniform(0.5, 0.95, n_rows)[:, None])
+
+    return {'confirmed' : confirmed, 'deaths' : deaths, 'recovered' : recovered}
+
+
+def write_jhu_files(folder, countries, n_provinces, n_days, first_date = '2020-01-22', seed = 0):
+    """
+    Write the confirmed, deaths & recovered csv files in the JHU layout,
+    named as in process_data.files (i.e. to be served as base_url)
+
+    Parameters:
+    folder (string): folder to write the files to
+    countries (pandas dataframe): output of synthetic_countries
+    n_provinces (int): rows (provinces) per country
+    n_days (int): number of days (date columns)
+    first_date (string): first date (yyyy-mm-dd)
+    seed (int): random seed
+
+    Returns:
+    dictionary with per metric (global_confirmed, ...) the written dataframe
+    """
+    first = datetime.strptime(first_date, '%Y-%m-%d')
+    dates = [first + timedelta(days = i) for i in range(n_days)]
+    date_cols = ['{}/{}/{}'.format(d.month, d.day, d.strftime('%y')) for d in dates]
+
+    # one row per province, a country without provinces has a missing Province/State
+    rows = pd.DataFrame({'Province/State' : [None if n_provinces == 1 else 'Province {}'.format(p)
+                                             for _ in countries['country'] for p in range(n_provinces)],
+                         'Country/Region' : np.repeat(countries['country'].to_numpy(), n_provinces),
+                         'Lat' : 0.0,
+                         'Long' : 0.0})
+
+    cases = synthetic_cases(len(rows), n_days, seed)
+    frames = {}
+    for metric, file_name in files.items():
+        values = pd.DataFrame(cases[metric.split('_')[-1]], columns = date_cols)
+        frames[metric] = pd.concat([rows, values], axis = 1)
+        frames[metric].to_csv(os.path.join(folder, file_name), index = False)
+
+    return frames
+
+
+def write_db(path, countries, frames, n_days):
+    """
+    Create a covid DB with the stats (first n_days days of the csv data)
+    and populations tables, with the same schema as the real DB
+
+    Parameters:
+    path (string): sqlite file to create
+    countries (pandas dataframe): output of synthetic_countries
+    frames (dict): output of write_jhu_files
+    n_days (int): number of days to load in the stats table
+
+    Returns:
+    queryDB connected to the new DB
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    qdb = queryDB('sqlite', path)
+
+    qdb.admin_query("""
+        CREATE TABLE stats (
+            country varchar NOT NULL,
+            date date(1) NOT NULL,
+            confirmed int,
+            deaths int,
+            recovered int,
+            PRIMARY KEY (country, date))""")
+    qdb.admin_query("""
+        CREATE TABLE populations (
+            rank INT,
+            country TEXT,
+            population INT,
+            yearly_change_pct NUM,
+            net_change INT,
+            density INT,
+            land_are INT,
+            migrants INT,
+            fert_rate NUM,
+            med_age INT,
+            urban_pop_pct INT,
+            world_share_pct NUM,
+            continent varchar)""")
+
+    # stats: cleaned as by update_db, only the first n_days
+    stats = None
+    for metric, df in frames.items():
+        col_name = metric.split('_')[-1]
+        clean = cleanMainDataset(df.iloc[:, :4 + n_days], col_name)
+        stats = clean if stats is None else stats.merge(clean, on = ['country','date'])
+    stats.to_sql('stats', con = qdb.engine, if_exists = 'append', index = False, chunksize = 10000)
+
+    rng = np.random.default_rng(len(countries))
+    populations = countries.assign(population = rng.integers(10**5, 10**9, len(countries)),
+                                   rank = np.arange(1, len(countries) + 1))
+    populations[['rank','country','population','continent']] \
+        .to_sql('populations', con = qdb.engine, if_exists = 'append', index = False)
+
+    qdb.ensure_indexes()
+    qdb.analyze()
+
+    return qdb
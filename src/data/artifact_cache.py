@@ -0,0 +1,187 @@
+import os
+import glob
+import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import pyarrow.feather as feather
+except ImportError: # optional, without pyarrow nothing is persisted
+    feather = None
+
+try:
+    import fcntl
+except ImportError: # not available on windows, run without lock
+    fcntl = None
+
+# absolute paths, also valid when called outside of src/visualization
+data_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/')
+
+# bump when the content or format of the cached frames changes
+CACHE_VERSION = 1
+
+# file hashes per path, with the size & modification time they were taken at
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+
+def file_hash(path):
+    """
+    Hash of a file's content, remembered per process as long as the file's
+    size and modification time don't change
+
+    Parameters:
+    path (string): file to hash
+
+    Returns:
+    sha1 hex digest (string), 'missing' if the file doesn't exist
+    """
+    if not os.path.exists(path):
+        return 'missing'
+
+    stat = os.stat(path)
+    with _hashes_lock:
+        known = _hashes.get(path)
+        if known is not None and known[0] == (stat.st_size, stat.st_mtime):
+            return known[1]
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+
+    with _hashes_lock:
+        _hashes[path] = ((stat.st_size, stat.st_mtime), sha1.hexdigest())
+
+    return sha1.hexdigest()
+
+
+@contextmanager
+def file_lock(path, blocking = True):
+    """
+    Lock between processes, i.e. such that a single process writes a file
+
+    Parameters:
+    path (string): lock file
+    blocking (bool): wait for the lock, else give up if already locked
+
+    Returns:
+    context manager yielding whether the lock was acquired
+    """
+    with open(path, 'w') as lock:
+        if fcntl is None:
+            yield True
+            return
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError: # another process holds the lock
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class ArtifactCache:
+    """
+    Versioned on-disk cache of prepared dataframes (query results), such
+    that a new process loads a file instead of re-running the SQL. Each
+    frame is stored as an uncompressed feather (Arrow) file, read
+    memory-mapped, and keyed by the DB version (data_version), the source
+    files it depends on and CACHE_VERSION. Files of older keys are removed.
+
+    Parameters:
+    folder (string): folder to store the files in
+    """
+    def __init__(self, folder = None):
+        self.folder = data_folder + 'processed/cache/' if folder is None else folder
+        self.enabled = feather is not None
+
+
+    def key(self, db_version, sources = ()):
+        """
+        Key of a cached frame
+
+        Parameters:
+        db_version: version of the data in the DB (queryDB.data_version)
+        sources (list): files the frame depends on (i.e. shapefiles)
+
+        Returns:
+        key (string)
+        """
+        parts = [str(CACHE_VERSION), str(db_version)] + [file_hash(path) for path in sources]
+        return hashlib.sha1('|'.join(parts).encode()).hexdigest()[:16]
+
+
+    def path(self, name, key):
+        return os.path.join(self.folder, '{}-{}.feather'.format(name, key))
+
+
+    def get(self, name, db_version, builder, sources = ()):
+        """
+        Get a frame from the cache, building & storing it when not cached
+        for this key
+
+        Parameters:
+        name (string): name of the frame
+        db_version: version of the data in the DB (queryDB.data_version)
+        builder (function): function without arguments returning the frame
+        sources (list): files the frame depends on
+
+        Returns:
+        pandas dataframe
+        """
+        if not self.enabled:
+            return builder()
+
+        path = self.path(name, self.key(db_version, sources))
+        if os.path.exists(path):
+            try:
+                return feather.read_table(path, memory_map = True).to_pandas()
+            except Exception as e:
+                print('unable to read {}, rebuilding: {}'.format(path, e))
+
+        df = builder()
+        self.save(path, df)
+        return df
+
+
+    def save(self, path, df):
+        """
+        Store a frame (atomically, other processes may read it) and remove
+        the files of older keys
+
+        Parameters:
+        path (string): file to store the frame in
+        df (pandas dataframe): frame to store
+        """
+        try:
+            os.makedirs(self.folder, exist_ok = True)
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            feather.write_feather(df.reset_index(drop = True), tmp, compression = 'uncompressed')
+            os.replace(tmp, path)
+        except Exception as e:
+            print('unable to cache {}: {}'.format(path, e))
+            return
+
+        name = os.path.basename(path).rsplit('-', 1)[0]
+        for old in glob.glob(os.path.join(self.folder, name + '-*.feather')):
+            if old != path:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+
+    def clear(self):
+        """
+        Remove all cached frames
+        """
+        for path in glob.glob(os.path.join(self.folder, '*.feather')):
+            os.remove(path)
+
+
+artifacts = ArtifactCache()
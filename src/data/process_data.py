@@ -1,9 +1,112 @@
+import os
+import json
+import urllib.request
+import urllib.error
+import numpy as np
 import pandas as pd
-import ssl
-ssl._create_default_https_context = ssl._create_unverified_context
 
-from src.data.quick_queries import queryDB
-qdb = queryDB('sqlite','../../data/processed/covid_db.sqlite')
+from src.data.quick_queries import qdb
+from src.metrics import timed
+# absolute paths, also valid when called outside of src/visualization (i.e. in a thread)
+data_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/')
+
+# base url to download csv data from github
+base_url = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/'
+
+# file-specific url, downloads are cached as <key>.csv in download_folder
+# (untracked); the snapshot in raw_folder (tracked) is used until then
+files = {
+    'global_confirmed' : 'time_series_covid19_confirmed_global.csv',
+    'global_deaths' : 'time_series_covid19_deaths_global.csv',
+    'global_recovered' : 'time_series_covid19_recovered_global.csv'
+}
+raw_folder = data_folder + 'raw/'
+download_folder = data_folder + 'raw/cache/'
+
+
+# identifying (non-date) columns of the wide JHU files
+id_columns = ['Province/State','Country/Region','Lat','Long']
+
+# not countries or inconsistent with the other datasets
+excluded_countries = ['Diamond Princess','MS Zaandam','Kosovo']
+
+# JHU names to the names in the other datasets [old to new]
+country_translation = {
+    "Cote d'Ivoire" : 'Ivory Coast',
+    'Burma' : 'Myanmar',
+    'Congo (Brazzaville)' : 'Congo',
+    'Congo (Kinshasa)' : 'DR Congo',
+    'West Bank and Gaza' : 'State of Palestine',
+    'Taiwan*' : 'Taiwan',
+    'Czechia' : 'Czech Republic',
+    'Korea, South' : 'South Korea',
+    'US' : 'United States'}
+
+
+def parse_dates(columns):
+    """
+    Date columns of a JHU file (m/d/yy) as yyyy-mm-dd, each header parsed once
+    """
+    return pd.to_datetime(pd.Index(columns), format = '%m/%d/%y').strftime('%Y-%m-%d').tolist()
+
+
+def country_groups(names):
+    """
+    Group the rows (provinces) of a JHU file by cleaned country. Names are
+    renamed & excluded on the unique names (categorical lookup), not per row.
+
+    Parameters:
+    names (list or series): Country/Region per row
+
+    Returns:
+    rows (numpy array, rows to sum, ordered by country), starts (numpy
+    array, first position in rows per country) and countries (sorted list)
+    """
+    codes, uniques = pd.factorize(np.asarray(names))
+    cleaned = [country_translation.get(name, name) for name in uniques]
+    countries = sorted(set(cleaned) - set(excluded_countries))
+
+    position = {country : i for i, country in enumerate(countries)}
+    country_codes = np.array([position.get(name, -1) for name in cleaned])[codes]
+
+    rows = np.argsort(country_codes, kind = 'stable')
+    rows = rows[country_codes[rows] >= 0]
+    starts = np.flatnonzero(np.diff(country_codes[rows], prepend = -1) != 0)
+    return rows, starts, countries
+
+
+def sum_by_country(values, rows, starts):
+    """
+    Sum the rows (provinces) of a block of date columns per country, missing
+    values count as 0
+
+    Returns:
+    integer numpy array of countries x dates
+    """
+    values = np.nan_to_num(np.asarray(values, dtype = 'float64')[rows])
+    return np.add.reduceat(values, starts, axis = 0).astype('int64')
+
+
+def long_table(countries, dates, metrics):
+    """
+    Build the long table (one row per date & country, dates first) from the
+    country x date arrays of the metrics, without merges
+
+    Parameters:
+    countries (list): countries (rows of the arrays)
+    dates (list): dates yyyy-mm-dd (columns of the arrays)
+    metrics (dict): output column and integer numpy array countries x dates
+
+    Returns:
+    dataframe with columns ['country','date'] + the metrics
+    """
+    n_countries, n_dates = len(countries), len(dates)
+    df = pd.DataFrame({'country' : pd.Categorical.from_codes(np.tile(np.arange(n_countries), n_dates), countries),
+                       'date' : np.repeat(np.array(dates, dtype = object), n_countries)})
+    for name, values in metrics.items():
+        df[name] = values.T.ravel()
+
+    return df
 
 
 def cleanMainDataset(df, column_name):
@@ -18,129 +121,432 @@ def cleanMainDataset(df, column_name):
     Returns:
     cleaned dataframe with columns ['country','date',column_name]
     """
+    date_cols = [c for c in df.columns if c not in id_columns]
+    rows, starts, countries = country_groups(df['Country/Region'])
 
-    # rename columns
-    df1 = df.copy()
-    df1.rename(columns = {'Country/Region' : 'country',
-                         'Province/State' : 'state',
-                                    'Lat' : 'lat',
-                                   'Long' : 'long'}, inplace = True)
+    return long_table(countries, parse_dates(date_cols),
+                      {column_name : sum_by_country(df[date_cols].to_numpy(), rows, starts)})
 
-    # remove country-data
-    df1.drop(['lat','long'], axis = 1, inplace = True)
 
-    # aggregate to country-level
-    df_country = df1.groupby('country').sum().reset_index()
-    assert df1[df1['country'] =='Australia']['5/7/20'].sum() == \
-           df_country[df_country['country'] == 'Australia']['5/7/20'].iloc[0]
+def read_by_country(path, date_cols, chunk_size = 512):
+    """
+    Read a wide JHU file summed per country, streaming chunk_size date
+    columns at a time (memory independent of the number of dates)
 
-    # un-pivot table
-    df2 = df_country.melt(id_vars = ["country"],
-                         var_name = "date",
-                       value_name = column_name)
+    Parameters:
+    path (string): csv file
+    date_cols (list): date columns to read
+    chunk_size (int): date columns per chunk
 
-    assert df2[(df2['country'] == 'Australia') & \
-           (df2['date'] == '5/7/20')][column_name].iloc[0] == \
-           df_country[df_country['country'] == 'Australia']['5/7/20'].iloc[0]
+    Returns:
+    countries (sorted list) and integer numpy array of countries x date_cols
+    """
+    rows, starts, countries = country_groups(pd.read_csv(path, usecols = ['Country/Region'])['Country/Region'])
 
-    # format date to 'yyyy-mm-dd
-    df2['date'] = pd.to_datetime(df2['date'], format = '%m/%d/%y').astype(str)
+    values = np.empty((len(countries), len(date_cols)), dtype = 'int64')
+    for i in range(0, len(date_cols), chunk_size):
+        chunk = date_cols[i:i + chunk_size]
+        block = pd.read_csv(path, usecols = chunk, dtype = 'float64')[chunk]
+        values[:, i:i + len(chunk)] = sum_by_country(block.to_numpy(), rows, starts)
 
-    # remove inconsistent countries
-    df2 = df2[~df2['country'].isin(['Diamond Princess','MS Zaandam','Kosovo'])]
-    assert len(df2[df2['country'].isin(['Diamond Princess','MS Zaandam','Kosovo'])]) == 0
+    return countries, values
 
-    # update names for consistency with other datasets
-    trans_stats = {
-                    "Cote d'Ivoire" : 'Ivory Coast',
-                    'Burma' : 'Myanmar',
-                    'Congo (Brazzaville)' : 'Congo',
-                    'Congo (Kinshasa)' : 'DR Congo',
-                    'West Bank and Gaza' : 'State of Palestine',
-                    'Taiwan*' : 'Taiwan',
-                    'Czechia' : 'Czech Republic',
-                    'Korea, South' : 'South Korea',
-                    'US' : 'United States'}
-    df2.replace(trans_stats, inplace=True)
-    assert len(df2[df2['country'].isin(list(trans_stats.keys()))]) == 0
 
-    return df2
+def clean_files(paths, last_date = None, chunk_size = 512):
+    """
+    Clean the wide JHU files into a single long table with a column per
+    metric, only the dates after last_date. Countries & dates missing in one
+    of the files are left out.
 
+    Parameters:
+    paths (dict): output column (metric) and csv file
+    last_date (string): last date already processed (yyyy-mm-dd), None for all
+    chunk_size (int): date columns read at a time
 
-def download_data():
+    Returns:
+    cleaned dataframe with columns ['country','date'] + the metrics
     """
-    Dowload and clean the covid data from hardcoded endpoint.
+    # dates in all files, each header parsed once
+    columns = {metric : new_date_columns(path, last_date) for metric, path in paths.items()}
+    dates = [dt for dt in columns[list(paths)[0]] if all(dt in cols for cols in columns.values())]
+
+    if len(dates) == 0:
+        return pd.DataFrame(columns = ['country','date'] + list(paths))
+
+    by_country = {metric : read_by_country(path, [columns[metric][dt] for dt in dates], chunk_size)
+                  for metric, path in paths.items()}
+
+    # countries in all files
+    countries = sorted(set.intersection(*[set(c) for c, _ in by_country.values()]))
+    metrics = {}
+    for metric, (metric_countries, values) in by_country.items():
+        position = {country : i for i, country in enumerate(metric_countries)}
+        metrics[metric] = values[[position[country] for country in countries]]
+
+    return long_table(countries, dates, metrics)
 
-    Parameters: None
+
+def fetch_file(url, path, cache_info, timeout = 60):
+    """
+    Download url to path, unless the cached file at path is still up-to-date
+    (conditional request using the ETag / Last-Modified of the last download)
+
+    Parameters:
+    url (string): file to download
+    path (string): local file to store the download
+    cache_info (dict): ETag / Last-Modified per url, updated on download
+    timeout (int): timeout in seconds of the request
 
     Returns:
-    cleaned dataframe with columns ['country','date',column_name]
+    True if a new file was downloaded, False if the cached file is up-to-date
     """
-    # base url to download csv data from github
-    base_url = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/'
+    request = urllib.request.Request(url)
+    info = cache_info.get(url, {})
+    if os.path.exists(path):
+        if info.get('etag'):
+            request.add_header('If-None-Match', info['etag'])
+        if info.get('last_modified'):
+            request.add_header('If-Modified-Since', info['last_modified'])
 
-    # file-specific url
-    files = {
-        'global_confirmed' : 'time_series_covid19_confirmed_global.csv',
-        'global_deaths' : 'time_series_covid19_deaths_global.csv',
-        'global_recovered' : 'time_series_covid19_recovered_global.csv'
-    }
+    try:
+        with urllib.request.urlopen(request, timeout = timeout) as response:
+            content = response.read()
+            headers = response.headers
 
-    for metric in files.keys():
-        # get the column name for the downloaded set
-        col_name = metric.split('_')[-1]
-        df_tmp = pd.read_csv(base_url + files[metric])
+    except urllib.error.HTTPError as e:
+        if e.code == 304: # not modified
+            return False
+        raise
 
-        # create output table
-        if metric == list(files.keys())[0]:
-            df = cleanMainDataset(df_tmp, col_name)
-        else:
-            df = df.merge(cleanMainDataset(df_tmp, col_name), on = ['country','date'])
+    # write via a temporary file, never leaving a partial file in the cache
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
 
-    return df
+    cache_info[url] = {'etag' : headers.get('ETag'),
+                       'last_modified' : headers.get('Last-Modified')}
+    return True
 
 
-def update_db():
+def new_date_columns(path, last_date = None):
     """
-    Update the stats table with new data (new days). Note: this requires
-    connetion to db to be established in qdb (quick_queries module).
+    Get the date columns in a (wide) JHU file after last_date, only reading
+    the header of the file
 
-    Parameters: None
+    Parameters:
+    path (string): csv file with one column per date (m/d/yy)
+    last_date (string): last date already processed (yyyy-mm-dd), None for all
+
+    Returns:
+    dictionary with date (yyyy-mm-dd) and column name, in file order
+    """
+    header = pd.read_csv(path, nrows = 0).columns
+    date_cols = [c for c in header if c not in id_columns]
+
+    return {dt : col for dt, col in zip(parse_dates(date_cols), date_cols)
+            if last_date is None or dt > last_date}
+
+
+@timed('download_data')
+def download_data(last_date = None, url = None, folder = None):
+    """
+    Dowload and clean the covid data from hardcoded endpoint. Files are only
+    downloaded when changed since the last download (cached in folder) and
+    only dates after last_date are cleaned. When a file can't be downloaded
+    and nothing is cached yet, the snapshot in raw_folder is used.
+
+    Parameters:
+    last_date (string): last date already in the DB (yyyy-mm-dd), None for all
+    url (string): base url of the files, default base_url (JHU github)
+    folder (string): folder of the local file cache, default download_folder
+
+    Returns:
+    cleaned dataframe with columns ['country','date',column_name], empty
+    when there are no dates after last_date
+    """
+    url = base_url if url is None else url
+    folder = download_folder if folder is None else folder
+    os.makedirs(folder, exist_ok = True)
+
+    # ETag / Last-Modified of the cached files
+    cache_file = os.path.join(folder, 'download_cache.json')
+    cache_info = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache_info = json.load(f)
+
+    # get the files if changed, fall back on the cached file (or the
+    # snapshot) if unavailable
+    paths = {}
+    for metric in files.keys():
+        path = os.path.join(folder, metric + '.csv')
+        try:
+            fetch_file(url + files[metric], path, cache_info)
+        except (urllib.error.URLError, OSError) as e:
+            if not os.path.exists(path):
+                path = os.path.join(raw_folder, metric + '.csv')
+                if not os.path.exists(path):
+                    raise
+            print('unable to download ' + metric + ', using ' + path)
+            print(str(e))
+        paths[metric.split('_')[-1]] = path
+
+    tmp = '{}.{}.tmp'.format(cache_file, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache_info, f, indent = 2)
+    os.replace(tmp, cache_file)
+
+    # only read & clean the new dates, all metrics in one table
+    return clean_files(paths, last_date)
+
+
+@timed('update_daily_stats')
+def update_daily_stats(from_date = None):
+    """
+    Maintain the daily_stats table (see write_daily_stats) in a transaction
+    of its own, i.e. to complete daily_stats without an update of stats
+
+    Parameters:
+    from_date (string): also recompute the dates from here (yyyy-mm-dd), i.e.
+                        after a revision of stats, None to only add dates
+                        not yet in daily_stats
 
     Returns: None (update db)
     """
     try:
-        #download new data
-        new_df = download_data()
+        with qdb.engine.begin() as conn:
+            write_daily_stats(conn, from_date)
+    except Exception as e:
+        print('unable to update daily_stats')
+        print("---")
+        print(str(e))
+        print("---")
 
-        #check what data is to be added
-        last_date = qdb.output_query("SELECT MAX(date) FROM stats").iloc[0][0]
-        if new_df['date'].max() > last_date:
-
-            # select new data and update table
-            update_df = new_df[new_df['date'] > last_date]
-            update_df.to_sql('stats', con = qdb.engine, if_exists = 'append', index=False, chunksize = 1000)
-
-            #check
-            query = """
-            SELECT date,
-                   COUNT(*) AS countries
-              FROM stats
-             GROUP BY date
-             ORDER BY date DESC
-             LIMIT 5;
+    qdb.ensure_indexes()
+
+
+def write_daily_stats(conn, from_date = None):
+    """
+    Maintain the daily_stats table: stats incl. global totals, scaling to
+    population, daily new cases, 7-day moving averages and the daily rank
+    groups. Only dates after the last date in daily_stats are (re)computed,
+    using a look-back window of 7 days for the daily deltas & averages. The
+    data version is bumped when daily_stats changes.
+
+    Parameters:
+    conn: connection of the transaction to write in, such that the sessions
+          see the changes of stats, daily_stats & the version all at once
+    from_date (string): also recompute the dates from here (yyyy-mm-dd), i.e.
+                        after a revision of stats, None to only add dates
+                        not yet in daily_stats
+
+    Returns:
+    number of rows (re)computed
+    """
+    # create the tables if not yet there
+    qdb.admin_query("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            country varchar NOT NULL,
+            date date(1) NOT NULL,
+            confirmed int,
+            deaths int,
+            recovered int,
+            confirmed_scaled int,
+            deaths_scaled int,
+            recovered_scaled int,
+            death_rate real,
+            daily_confirmed int,
+            daily_deaths int,
+            daily_recovered int,
+            daily_confirmed_ma7 real,
+            daily_deaths_ma7 real,
+            daily_recovered_ma7 real,
+            conf_group int,
+            PRIMARY KEY (country, date))""", conn = conn)
+    qdb.admin_query("""
+        CREATE TABLE IF NOT EXISTS data_version (
+            id int PRIMARY KEY CHECK (id = 1),
+            version int NOT NULL,
+            last_date date(1))""", conn = conn)
+
+    # first date to (re)compute: the first date not yet in daily_stats
+    next_date = qdb.output_query("""
+        SELECT date(COALESCE((SELECT MAX(date) FROM daily_stats),
+                             date((SELECT MIN(date) FROM stats), '-1 day')),
+                    '+1 day') AS date""", conn = conn)['date'].iloc[0]
+    from_date = next_date if from_date is None else min(from_date, next_date)
+
+    deleted = qdb.admin_query("DELETE FROM daily_stats WHERE date >= :from_date", {'from_date' : from_date}, conn = conn)
+
+    # compute the new dates, starting 7 days earlier for the deltas/averages
+    query = """
+            INSERT INTO daily_stats
+            WITH cases_rollup AS (
+                    SELECT 'total' AS country,
+                           date,
+                           SUM(confirmed) AS confirmed,
+                           SUM(deaths) AS deaths,
+                           SUM(recovered) AS recovered
+                      FROM stats
+                     WHERE date >= date(:from_date, '-7 days')
+                     GROUP BY date
+
+                     UNION
+
+                    SELECT country,
+                           date,
+                           confirmed,
+                           deaths,
+                           recovered
+                      FROM stats
+                     WHERE date >= date(:from_date, '-7 days')),
+
+            scaled_to_pop AS (
+                SELECT cases_rollup.country,
+                       date,
+                       confirmed,
+                       deaths,
+                       recovered,
+                       CAST(confirmed/scaled_pop AS int) AS confirmed_scaled,
+                       CAST(deaths/scaled_pop AS int) AS deaths_scaled,
+                       CAST(recovered/scaled_pop AS int) AS recovered_scaled
+                  FROM cases_rollup
+                       LEFT JOIN (SELECT country,
+                                         population/1000000.0 AS scaled_pop
+                                    FROM populations) AS pops
+                              ON cases_rollup.country = pops.country),
+
+            daily AS (
+                SELECT *,
+                       ROUND(deaths*1.0 / MAX(confirmed,1),2) AS death_rate,
+                       COALESCE(confirmed - LAG(confirmed) OVER daily_window,0) AS daily_confirmed,
+                       COALESCE(deaths - LAG(deaths) OVER daily_window,0) AS daily_deaths,
+                       COALESCE(recovered - LAG(recovered) OVER daily_window,0) AS daily_recovered
+                  FROM scaled_to_pop
+                  WINDOW daily_window AS (PARTITION BY country ORDER BY date)),
+
+            moving_avg AS (
+                SELECT *,
+                       ROUND(AVG(daily_confirmed) OVER ma7,2) AS daily_confirmed_ma7,
+                       ROUND(AVG(daily_deaths) OVER ma7,2) AS daily_deaths_ma7,
+                       ROUND(AVG(daily_recovered) OVER ma7,2) AS daily_recovered_ma7,
+                       DENSE_RANK() OVER (PARTITION BY date ORDER BY CAST(confirmed_scaled AS int)) AS conf_group
+                  FROM daily
+                  WINDOW ma7 AS (PARTITION BY country ORDER BY date ROWS BETWEEN 6 PRECEDING AND CURRENT ROW))
+
+            SELECT *
+              FROM moving_avg
+             WHERE date >= :from_date
             """
-            last_day_check = qdb.output_query(query)
-            assert last_day_check['date'].max() == update_df['date'].max()
-            assert last_day_check['countries'].to_list() == [185, 185, 185, 185, 185]
+    inserted = qdb.admin_query(query, {'from_date' : from_date}, conn = conn)
+
+    # new version when changed (and the first version of an unversioned DB)
+    qdb.admin_query("""
+        INSERT INTO data_version (id, version, last_date)
+        SELECT 1, 1, MAX(date) FROM daily_stats WHERE true
+            ON CONFLICT (id) DO UPDATE SET version = version + 1,
+                                           last_date = excluded.last_date
+         WHERE :changed""", {'changed' : deleted + inserted > 0}, conn = conn)
+
+    return inserted
+
+
+def download_update(from_date = None):
+    """
+    Download and clean the days to add to the stats table (see update_db),
+    without writing to the DB, i.e. such that the DB isn't locked during the
+    download
+
+    Parameters:
+    from_date (string): also the days from here (yyyy-mm-dd), None for only
+                        the days after the last date in stats
+
+    Returns:
+    cleaned dataframe (see download_data)
+    """
+    #check what data is to be added
+    last_date = qdb.output_query("SELECT MAX(date) FROM stats").iloc[0][0]
+    since = last_date if from_date is None else (pd.Timestamp(from_date) - pd.Timedelta(days = 1)).strftime('%Y-%m-%d')
+
+    #download new data (only days after since)
+    return download_data(since)
 
-            print('COVID data up-to-date till ' + last_day_check['date'].max())
 
+@timed('update_db')
+def update_db(from_date = None, update_df = None):
+    """
+    Update the stats table with new data (new days) and add these days to
+    the daily_stats table. Rows are upserted on (country, date), so a window
+    of past days revised by JHU (or left incomplete by a failed update) can
+    be re-ingested with from_date. Note: this requires connetion to db to be
+    established in qdb (quick_queries module).
+
+    Parameters:
+    from_date (string): also re-ingest the days from here (yyyy-mm-dd), None
+                        to only add the days after the last date in stats
+    update_df (pandas dataframe): the data of download_update(from_date),
+                                  i.e. downloaded before locking the DB,
+                                  None to download it here
+
+    Returns:
+    last date in the stats table (string), None if the update failed (rolled
+    back)
+    """
+    changed, written = 0, False
+    try:
+        last_date = qdb.output_query("SELECT MAX(date) FROM stats").iloc[0][0]
+        if update_df is None:
+            update_df = download_update(from_date)
+
+        # stats, daily_stats & the data version in a single transaction: the
+        # sessions see all of the update or none of it
+        with qdb.engine.begin() as conn:
+            if len(update_df) > 0:
+
+                # upsert, only changed rows are written
+                changed = qdb.upsert('stats', update_df, ['country', 'date'], conn = conn)
+
+                #check: only the loaded dates, each with the countries loaded
+                query = """
+                SELECT date,
+                       COUNT(*) AS countries
+                  FROM stats
+                 WHERE date BETWEEN :first_date AND :last_date
+                 GROUP BY date
+                """
+                loaded = update_df.groupby('date').size()
+                check = qdb.output_query(query, params = {'first_date' : loaded.index.min(),
+                                                          'last_date' : loaded.index.max()},
+                                         conn = conn).set_index('date')['countries']
+                assert check.sort_index().equals(loaded.sort_index()), 'countries per date differ from the loaded data'
+
+            # also when no new data: creates daily_stats on first run. Revised
+            # days are recomputed (the look-back window of later days changed as well)
+            write_daily_stats(conn, from_date if changed > 0 else None)
+        written = True
+
+        if changed > 0:
+            print('COVID data up-to-date till {} ({} rows added or revised)'.format(loaded.index.max(), changed))
         else:
             print('COVID data up-to-date till ' + last_date)
 
     except Exception as e:
+        changed = 0 # rolled back
         print('unable to update db')
         print("---")
         print(str(e))
         print("---")
+
+    if not written:
+        # rolled back: daily_stats as it was (created on a first run)
+        update_daily_stats()
+        return None
+
+    qdb.ensure_indexes()
+
+    # planner statistics after the bulk load
+    if changed > 0:
+        qdb.analyze()
+
+    return qdb.output_query("SELECT MAX(date) FROM stats").iloc[0][0]
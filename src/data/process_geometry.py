@@ -0,0 +1,329 @@
+import os
+import numpy as np
+
+from src.data.artifact_cache import file_hash, file_lock
+from src.metrics import timed
+
+# absolute paths, also valid when called outside of src/visualization
+data_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/')
+raw_folder = data_folder + 'raw/'
+tiers_file = data_folder + 'processed/geometry_tiers.npz'
+
+# level of detail: simplification tolerance (degrees) per tier, coarse to fine
+geometry_tiers = {'coarse' : 0.5,
+                  'medium' : 0.1,
+                  'fine' : 0.0}
+
+# Natural Earth names to the country names in the stats table [old to new]
+# (see notebooks/data/2_geographic_data_wrangling.ipynb)
+country_translation = {
+    'United Republic of Tanzania' : 'Tanzania',
+    'Republic of the Congo' : 'Congo',
+    'Democratic Republic of the Congo' : 'DR Congo',
+    'Palestine' : 'State of Palestine',
+    'eSwatini' : 'Eswatini',
+    'The Bahamas' : 'Bahamas',
+    'Czechia' : 'Czech Republic',
+    'Macedonia' : 'North Macedonia',
+    'São Tomé and Principe' : 'Sao Tome and Principe',
+    'Republic of Serbia' : 'Serbia',
+    'United States of America' : 'United States',
+    'East Timor' : 'Timor-Leste',
+    'Vatican' : 'Holy See'}
+
+
+def read_natural_earth(scale):
+    """
+    Read a Natural Earth countries shapefile from the raw folder
+
+    Parameters:
+    scale (string): resolution, one of 10m, 50m or 110m
+
+    Returns:
+    geopandas dataframe with columns country & geometry, None if the
+    shapefile is not available
+    """
+    path = raw_folder + 'ne_{}_admin_0_countries.shp'.format(scale)
+    if not os.path.exists(path):
+        return None
+
+    # geopandas is only needed to (re)build the tiers, not on import
+    import geopandas as gpd
+    countries = gpd.read_file(path)[['ADMIN','geometry']]
+    countries['ADMIN'] = countries['ADMIN'].replace(country_translation)
+    countries.columns = ['country','geometry']
+
+    return countries
+
+
+def base_geometry():
+    """
+    Geometry at the highest resolution available (10m, else 50m) for each
+    country on the map (data/processed/countries.shp), in that order.
+    Countries missing at this resolution keep their geometry from
+    countries.shp.
+
+    Returns:
+    tuple of a geopandas dataframe (country, geometry) and a boolean
+    numpy array marking the rows taken from Natural Earth
+    """
+    import geopandas as gpd
+    countries = gpd.read_file(data_folder + 'processed/countries.shp')[['country','geometry']]
+
+    for scale in ['10m', '50m']:
+        natural_earth = read_natural_earth(scale)
+        if natural_earth is not None:
+            break
+    else:
+        return countries, np.zeros(len(countries), dtype = bool)
+
+    natural_earth = natural_earth.drop_duplicates('country').set_index('country')['geometry']
+    from_ne = countries['country'].isin(natural_earth.index).to_numpy()
+    countries.loc[from_ne, 'geometry'] = natural_earth[countries.loc[from_ne, 'country']].values
+
+    return countries, from_ne
+
+
+def simplify_geometry(geometry, tolerance):
+    """
+    Simplify polygons, keeping the shared borders of neighbouring countries
+    aligned where shapely supports it (coverage simplification, shapely>=2.1).
+    Otherwise each polygon is simplified separately (topology preserved
+    within the polygon).
+
+    Parameters:
+    geometry (geopandas series): polygons forming a coverage (no overlaps)
+    tolerance (float): tolerance in degrees, 0 to keep the geometry as is
+
+    Returns:
+    numpy array of simplified polygons
+    """
+    if tolerance == 0:
+        return geometry.values
+
+    import shapely
+    if hasattr(shapely, 'coverage_simplify'):
+        return shapely.coverage_simplify(np.asarray(geometry.values), tolerance)
+
+    return geometry.simplify(tolerance, preserve_topology = True).values
+
+
+def country_patches(geometry):
+    """
+    Convert polygons to patches: like bokeh's GeoJSONDataSource, only the
+    exterior of a polygon is drawn and the parts of a multipolygon are
+    separated by NaN. Stored flat, countries are split by offsets.
+
+    Parameters:
+    geometry (array): polygons & multipolygons
+
+    Returns:
+    tuple of coordinates (float32, N x 2) and offsets (int32, one more
+    than the number of countries)
+    """
+    coords, offsets = [], [0]
+    for geom in geometry:
+        polygons = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
+
+        # exteriors of all parts, separated by NaN
+        parts = []
+        for polygon in polygons:
+            parts += [np.asarray(polygon.exterior.coords)[:, :2], np.full((1, 2), np.nan)]
+
+        country = np.concatenate(parts[:-1]) if len(parts) > 0 else np.empty((0, 2))
+        coords.append(country)
+        offsets.append(offsets[-1] + len(country))
+
+    return np.concatenate(coords).astype('float32'), np.array(offsets, dtype = 'int32')
+
+
+def source_key():
+    """
+    Key of the files the geometry is build from, the tiers are rebuild
+    when one of them changes
+
+    Returns:
+    key (string)
+    """
+    sources = [data_folder + 'processed/countries.shp'] + \
+              [raw_folder + 'ne_{}_admin_0_countries.shp'.format(scale) for scale in ['10m', '50m']]
+    return '|'.join(file_hash(path) for path in sources)
+
+
+@timed('build_geometry_tiers')
+def build_geometry_tiers(tiers = geometry_tiers, path = tiers_file):
+    """
+    Precompute the simplified geometry for each level of detail and store
+    the patches in a single (compressed) numpy file
+
+    Parameters:
+    tiers (dict): tier and simplification tolerance in degrees
+    path (string): file to store the tiers in
+    """
+    countries, from_ne = base_geometry()
+
+    arrays = {'country' : countries['country'].to_numpy().astype(str),
+              'sources' : np.array(source_key())}
+    for tier, tolerance in tiers.items():
+        geometry = countries['geometry'].values.copy()
+
+        # simplify Natural Earth as one coverage, the remaining (small) countries separately
+        geometry[from_ne] = simplify_geometry(countries.loc[from_ne, 'geometry'], tolerance)
+        if (~from_ne).any():
+            geometry[~from_ne] = countries.loc[~from_ne, 'geometry'] \
+                                          .simplify(tolerance, preserve_topology = True).values
+
+        arrays[tier + '_coords'], arrays[tier + '_offsets'] = country_patches(geometry)
+        arrays[tier + '_tolerance'] = np.array(tolerance)
+
+    # atomically, other processes may be loading the file (a file object: np.savez adds .npz to a name)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp, path)
+
+    print('geometry tiers: ' + ', '.join('{} {:,} points'.format(tier, len(arrays[tier + '_coords']))
+                                         for tier in tiers))
+
+
+def read_geometry_tiers(tiers, path):
+    """
+    Read the stored tiers
+
+    Parameters:
+    tiers (dict): tier and simplification tolerance in degrees
+    path (string): file with the stored tiers
+
+    Returns:
+    dictionary with the stored arrays, None when the file is missing,
+    unreadable or build with different tolerances or from changed source
+    files
+    """
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with np.load(path) as stored:
+            if 'sources' not in stored or stored['sources'] != source_key() or \
+               any(tier + '_tolerance' not in stored or stored[tier + '_tolerance'] != tolerance
+                   for tier, tolerance in tiers.items()):
+                return None
+            return {name : stored[name] for name in stored.files}
+    except Exception as e:
+        print('unable to read {}, rebuilding: {}'.format(path, e))
+        return None
+
+
+@timed('load_geometry_tiers')
+def load_geometry_tiers(tiers = geometry_tiers, path = tiers_file):
+    """
+    Load the patches per level of detail, (re)building them when missing,
+    build with different tolerances or from changed source files. All tiers
+    have the same countries, in the same order.
+
+    Parameters:
+    tiers (dict): tier and simplification tolerance in degrees
+    path (string): file with the stored tiers
+
+    Returns:
+    dictionary with per tier a dictionary with columns country, xs and ys
+    (data for a bokeh ColumnDataSource)
+    """
+    stored = read_geometry_tiers(tiers, path)
+    if stored is None:
+        # a single process (bokeh worker) builds the tiers, the others wait and read them
+        with file_lock(path + '.lock'):
+            stored = read_geometry_tiers(tiers, path)
+            if stored is None:
+                build_geometry_tiers(tiers, path)
+                stored = read_geometry_tiers(tiers, path)
+
+    countries = stored['country'].tolist()
+    geometry = {}
+    for tier in tiers:
+        coords, offsets = stored[tier + '_coords'], stored[tier + '_offsets']
+        patches = [coords[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        geometry[tier] = {'country' : countries,
+                          'xs' : [patch[:, 0].copy() for patch in patches],
+                          'ys' : [patch[:, 1].copy() for patch in patches]}
+
+    return geometry
+
+
+def geometry_frames(geometry):
+    """
+    Flatten the tiers of load_geometry_tiers into frames, i.e. to publish
+    them to the workers of a multi-process deployment (see tiers_from_frames)
+
+    Parameters:
+    geometry (dict): output of load_geometry_tiers
+
+    Returns:
+    tuple of a pandas dataframe with per country its name and the start &
+    end of its points per tier, and a dictionary with per tier a pandas
+    dataframe of the points (x, y)
+    """
+    # pandas is only needed by the dashboard loaders, not on import
+    import pandas as pd
+    countries = pd.DataFrame({'country' : next(iter(geometry.values()))['country']})
+    points = {}
+    for tier, patches in geometry.items():
+        lengths = np.array([len(xs) for xs in patches['xs']], dtype = 'int32')
+        countries[tier + '_end'] = np.cumsum(lengths, dtype = 'int32')
+        countries[tier + '_start'] = countries[tier + '_end'] - lengths
+        points[tier] = pd.DataFrame({'x' : np.concatenate(patches['xs']),
+                                     'y' : np.concatenate(patches['ys'])})
+
+    return countries, points
+
+
+def tiers_from_frames(countries, points):
+    """
+    Patches per level of detail from the frames of geometry_frames. The
+    patches are views on the points, not copies (i.e. of memory-mapped
+    shared frames).
+
+    Parameters:
+    countries (pandas dataframe): countries & the start and end of their points per tier
+    points (dict): tier and pandas dataframe of its points
+
+    Returns:
+    dictionary with per tier a dictionary with columns country, xs and ys
+    (see load_geometry_tiers)
+    """
+    names = countries['country'].astype(str).tolist()
+    geometry = {}
+    for tier, frame in points.items():
+        x, y = frame['x'].to_numpy(), frame['y'].to_numpy()
+        bounds = list(zip(countries[tier + '_start'].to_numpy(), countries[tier + '_end'].to_numpy()))
+        geometry[tier] = {'country' : names,
+                          'xs' : [x[start:end] for start, end in bounds],
+                          'ys' : [y[start:end] for start, end in bounds]}
+
+    return geometry
+
+
+
+def part_bounds(patches):
+    """
+    Bounding box of each part of the countries' patches (i.e. islands), to
+    find the countries within the shown part of the map. Per part instead of
+    per country, a country with parts around the globe (i.e. the United
+    States) isn't always in view.
+
+    Parameters:
+    patches (dict): patches of a tier, with columns xs and ys (see
+                    load_geometry_tiers)
+
+    Returns:
+    numpy array with per part the index of the country, x0, y0, x1 & y1
+    """
+    bounds = []
+    for i, (xs, ys) in enumerate(zip(patches['xs'], patches['ys'])):
+        # parts are separated by NaN
+        breaks = np.flatnonzero(np.isnan(xs))
+        for start, end in zip(np.r_[0, breaks + 1], np.r_[breaks, len(xs)]):
+            if end > start:
+                bounds.append([i, xs[start:end].min(), ys[start:end].min(), xs[start:end].max(), ys[start:end].max()])
+
+    return np.array(bounds, dtype = 'float64').reshape(-1, 5)
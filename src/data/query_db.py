@@ -1,5 +1,5 @@
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 
 class queryDB:
     def __init__(self, driver, filename):
@@ -9,17 +9,19 @@ class queryDB:
         print(self.engine_string)
 
 
-    def execute_query(self, query, ret = True, dates = ['date']):
+    def execute_query(self, query, ret = True, dates = ['date'], params = None):
         """
-        Execute query
+        Execute query, with bound parameters (:name) given in params
         """
         try:
+            if params is not None:
+                query = text(query)
             if ret:
-                res = pd.read_sql(query, con = self.engine, parse_dates = dates)
+                res = pd.read_sql(query, con = self.engine, params = params, parse_dates = dates)
                 print(str(len(res)) + " rows affected")
                 return res
             else:
-                self.conn.execute(query)
+                self.conn.execute(query, params or {})
 
         except Exception as e:
             print('unable to execute query')
@@ -36,8 +38,8 @@ class queryDB:
         query = """
                 SELECT *
                   FROM daily_stats
-                 WHERE country = '{}';
-                """.format(country)
+                 WHERE country = :country;
+                """
 
         # run query
-        return self.execute_query(query)
+        return self.execute_query(query, params = {'country' : country})
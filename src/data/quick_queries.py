@@ -1,27 +1,132 @@
+import os
+import threading
 import pandas as pd
-from sqlalchemy import create_engine
+
+from src.metrics import timed
+
+# the covid DB, absolute path: also valid when called outside of src/visualization.
+# COVID_DB points to another DB, i.e. a copy for a load test
+db_file = os.environ.get('COVID_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                  '../../data/processed/covid_db.sqlite'))
+
+# compact dtypes per column, used when selecting with dtypes = 'default'
+column_dtypes = {
+    'country' : 'category',
+    'continent' : 'category',
+    'date' : 'datetime64[ns]',
+    'confirmed' : 'int32',
+    'deaths' : 'int32',
+    'recovered' : 'int32',
+    'confirmed_scaled' : 'float32',
+    'deaths_scaled' : 'float32',
+    'recovered_scaled' : 'float32',
+    'death_rate' : 'float32',
+    'daily_confirmed' : 'int32',
+    'daily_deaths' : 'int32',
+    'daily_recovered' : 'int32',
+    'daily_confirmed_ma7' : 'float32',
+    'daily_deaths_ma7' : 'float32',
+    'daily_recovered_ma7' : 'float32',
+    'conf_group' : 'int32',
+    'conf_rnk' : 'int32',
+    'min_rnk' : 'int32',
+    'plot_continent' : 'int32',
+    'confirmed_continent' : 'int32',
+    'deaths_continent' : 'int32',
+    'recovered_continent' : 'int32',
+    'new_last_week' : 'int32',
+    'population' : 'int64'}
+
+# indexes maintained by queryDB.ensure_indexes: name, table and columns. An
+# existing index on the same (leading) columns, i.e. the primary key, is used
+indexes = {'stats_country_date' : ('stats', ['country', 'date']),
+           'stats_date' : ('stats', ['date']),
+           'populations_country' : ('populations', ['country']),
+           'daily_stats_country_date' : ('daily_stats', ['country', 'date']),
+           'daily_stats_date' : ('daily_stats', ['date'])}
+
+# set on every sqlite connection: WAL such that readers (sessions) aren't
+# blocked by update_db, 64MB page cache & 256MB memory-mapped reads
+sqlite_pragmas = {'journal_mode' : 'WAL',
+                  'synchronous' : 'NORMAL',
+                  'cache_size' : -64000,
+                  'mmap_size' : 256 * 1024 * 1024,
+                  'temp_store' : 'MEMORY'}
+
+
+def set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in sqlite_pragmas.items():
+        cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+    cursor.close()
+
+
+def apply_dtypes(df, dtypes):
+    """
+    Convert the columns of a dataframe to the given dtypes. Integer columns
+    with missing values (NULL) are converted to float32 instead.
+
+    Parameters:
+    df (pandas dataframe): dataframe to convert (in place)
+    dtypes (dict): column and dtype, columns not in df are ignored
+
+    Returns:
+    df (pandas dataframe)
+    """
+    for col, dtype in dtypes.items():
+        if col not in df.columns:
+            continue
+        if dtype.startswith('int') and df[col].isna().any():
+            dtype = 'float32'
+        df[col] = df[col].astype(dtype)
+
+    return df
+
 
 class queryDB:
     def __init__(self, driver, filename):
+        # sqlalchemy is imported with the first connection, not on import
+        from sqlalchemy import create_engine, event
+
         self.engine_string = driver+":///"+filename
         self.engine = create_engine(self.engine_string)
-        self.conn = self.engine.connect()
-        print(self.engine_string)
+        if driver.startswith('sqlite'):
+            event.listen(self.engine, 'connect', set_pragmas)
+        self._statements = {}
+
+
+    def statement(self, query):
+        """
+        Get the (cached) sqlalchemy statement for a query with bound
+        parameters (:name). The same statement is reused for every call, so
+        sqlite can reuse the prepared statement.
+        """
+        if query not in self._statements:
+            from sqlalchemy import text
+            self._statements[query] = text(query)
+        return self._statements[query]
 
 
-    def output_query(self, query, dates = None):
+    def output_query(self, query, dates = None, params = None, dtypes = None, conn = None):
         """
         query the DB and return result as pandas dataframe
 
         Parameters:
-        query (string) : sql query to be exectuted
+        query (string) : sql query to be exectuted, parameters as :name
         dates : columns to be parsed as date in the returned dataframe
+        params (dict): values of the bound parameters in the query
+        dtypes (dict): dtype per column in the returned dataframe
+        conn: connection of an open transaction (engine.begin()) to query
+              in, default a connection from the pool
 
         Returns:
         query result as pandas dataframe
         """
         try:
-            return pd.read_sql(query, con = self.engine, parse_dates = dates)
+            if params is not None:
+                query = self.statement(query)
+            res = pd.read_sql(query, con = self.engine if conn is None else conn, params = params, parse_dates = dates)
+            return res if dtypes is None else apply_dtypes(res, dtypes)
         except Exception as e:
             print('unable to execute query')
             print("---")
@@ -29,15 +134,52 @@ class queryDB:
             print("---")
 
 
-    def admin_query(self,query):
+    def select(self, table, columns = None, where = None, params = None, order_by = None, dtypes = 'default'):
+        """
+        Select columns from a table, with a typed result
+
+        Parameters:
+        table (string): table to select from
+        columns (list): columns to select, None for all columns
+        where (string): condition with bound parameters, i.e. 'country = :country'
+        params (dict): values of the bound parameters in where
+        order_by (list): columns to order by
+        dtypes (dict): dtype per column, 'default' for column_dtypes
+
+        Returns:
+        query result as pandas dataframe
+        """
+        query = "SELECT {} FROM {}".format('*' if columns is None else ', '.join(columns), table)
+        if where is not None:
+            query += " WHERE " + where
+        if order_by is not None:
+            query += " ORDER BY " + ', '.join(order_by)
+
+        dtypes = column_dtypes if dtypes == 'default' else dtypes
+        return self.output_query(query, params = {} if params is None else params, dtypes = dtypes)
+
+
+    def admin_query(self, query, params = None, conn = None):
         """
         query the DB where no return statement is expected (CREATE/INSERT/ALTER)
 
         Parameters:
-        query (string) : sql query to be exectuted
+        query (string) : sql query to be exectuted, parameters as :name
+        params (dict): values of the bound parameters in the query
+        conn: connection of an open transaction (engine.begin()) to execute
+              in, errors are raised such that the transaction is rolled back.
+              Default a transaction of its own, errors are printed.
+
+        Returns:
+        number of rows affected, None on error
         """
+        if conn is not None:
+            return self.execute(conn, query, params)
+
         try:
-            self.conn.execute(query)
+            # connection from the pool: the query might run in another thread
+            with self.engine.begin() as conn:
+                return self.execute(conn, query, params)
         except Exception as e:
             print('unable to execute query')
             print("---")
@@ -45,61 +187,154 @@ class queryDB:
             print("---")
 
 
-    def get_coutry_data(self):
-        query = """
-                WITH cases_rollup AS (
-                        SELECT 'total' AS country,
-                               date,
-                               SUM(confirmed) AS confirmed,
-                               SUM(deaths) AS deaths,
-                               SUM(recovered) AS recovered
-                          FROM stats
-                         WHERE date >= '{}'
-                         GROUP BY date
-
-                         UNION
-
-                        SELECT *
-                          FROM stats
-                         WHERE date >= '{}'),
-
-                scaled_to_pop AS (
-                    SELECT cases_rollup.country,
-                           date,
-                           confirmed,
-                           deaths,
-                           recovered,
-                           CAST(confirmed/scaled_pop AS int) AS confirmed_scaled,
-                           CAST(deaths/scaled_pop AS int) AS deaths_scaled,
-                           CAST(recovered/scaled_pop AS int) AS recovered_scaled
-                      FROM cases_rollup
-                           LEFT JOIN (SELECT country,
-                                             population/1000000.0 AS scaled_pop
-                                        FROM populations) AS pops
-                                  ON cases_rollup.country = pops.country),
-
-                daily_stats AS (
-                    SELECT *,
-                           ROUND(deaths*1.0 / MAX(confirmed,1),2) AS death_rate,
-                           COALESCE(confirmed - LAG(confirmed) OVER daily_window,0) AS daily_confirmed,
-                           COALESCE(deaths - LAG(deaths) OVER daily_window,0) AS daily_deaths,
-                           COALESCE(recovered - LAG(recovered) OVER daily_window,0) AS daily_recovered
-                      FROM scaled_to_pop
-                      WINDOW daily_window AS (PARTITION BY country ORDER BY date))
-
-                SELECT *,
-                       ROUND(AVG(daily_confirmed) OVER ma7,2) AS daily_confirmed_ma7,
-                       ROUND(AVG(daily_deaths) OVER ma7,2) AS daily_deaths_ma7,
-                       ROUND(AVG(daily_recovered) OVER ma7,2) AS daily_recovered_ma7,
-                       DENSE_RANK() OVER (PARTITION BY date ORDER BY CAST(confirmed_scaled AS int)) AS conf_group
-                FROM daily_stats
-                WINDOW ma7 AS (PARTITION BY country ORDER BY date ROWS BETWEEN 6 PRECEDING AND CURRENT ROW)
-                ORDER BY date, country
-                """.format('2020-02-01','2020-02-01')
-        return self.output_query(query) # not required to reformat date
-
-
-    def get_top10_countries(self):
+    def execute(self, conn, query, params = None):
+        if params is None:
+            return conn.execute(query).rowcount
+        return conn.execute(self.statement(query), params).rowcount
+
+
+    def upsert(self, table, df, keys, chunk_size = 50000, conn = None):
+        """
+        Insert the rows of a dataframe, updating the existing rows with the
+        same keys (INSERT ... ON CONFLICT), via executemany in a single
+        transaction: either all rows are loaded or none. Existing rows with
+        unchanged values are not rewritten.
+
+        Parameters:
+        table (string): table to load into, with a unique index on keys
+        df (pandas dataframe): rows to load, columns as in the table
+        keys (list): columns identifying a row, i.e. ['country', 'date']
+        chunk_size (int): rows passed to executemany at a time
+        conn: connection of an open transaction (engine.begin()) to load in,
+              default a transaction of its own
+
+        Returns:
+        number of rows inserted or changed (int)
+        """
+        columns = list(df.columns)
+        values = [col for col in columns if col not in keys]
+        query = "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) ".format(table, ', '.join(columns),
+                                                                          ', '.join('?' * len(columns)),
+                                                                          ', '.join(keys))
+        if len(values) == 0:
+            query += "DO NOTHING"
+        else:
+            query += "DO UPDATE SET {} WHERE {}".format(
+                ', '.join('{0} = excluded.{0}'.format(col) for col in values),
+                ' OR '.join('{0} IS NOT excluded.{0}'.format(col) for col in values))
+
+        if conn is None:
+            with self.engine.begin() as conn:
+                return self.upsert(table, df, keys, chunk_size, conn)
+
+        changed = 0
+        for start in range(0, len(df), chunk_size):
+            # python objects, the sqlite driver doesn't bind numpy scalars
+            rows = list(df.iloc[start:start + chunk_size].astype(object).itertuples(index = False, name = None))
+            changed += conn.exec_driver_sql(query, rows).rowcount
+
+        return changed
+
+
+    def data_version(self):
+        """
+        Version of the data in the DB: the last date in daily_stats and the
+        counter of the data_version table, bumped in the transaction that
+        changes stats & daily_stats (see process_data.update_daily_stats).
+        Also changes when past days are revised.
+
+        Returns:
+        version (string), i.e. '2020-07-13.4', None if not yet versioned
+        """
+        with self.engine.connect() as conn:
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'data_version'").first() is None:
+                return None
+            row = conn.execute("SELECT last_date, version FROM data_version").first()
+
+        return None if row is None else '{}.{}'.format(*row)
+
+
+    def index_report(self):
+        """
+        Check the indexes in indexes: for each, the existing index on the
+        same (leading) columns, if any. Tables not (yet) in the DB are skipped.
+
+        Returns:
+        pandas dataframe with columns name, table, columns and index (name
+        of the existing index, None if missing)
+        """
+        report = []
+        with self.engine.connect() as conn:
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            for name, (table, columns) in indexes.items():
+                if table not in tables:
+                    continue
+
+                found = None
+                for index in conn.execute("PRAGMA index_list({})".format(table)):
+                    index_columns = [row[2] for row in conn.execute("PRAGMA index_info('{}')".format(index[1]))]
+                    if index_columns[:len(columns)] == columns:
+                        found = index[1]
+                        break
+                report.append((name, table, ', '.join(columns), found))
+
+        return pd.DataFrame(report, columns = ['name', 'table', 'columns', 'index'])
+
+
+    def ensure_indexes(self):
+        """
+        Create the indexes in indexes which are missing
+
+        Returns:
+        index_report after creating the missing indexes
+        """
+        for _, row in self.index_report().iterrows():
+            if row['index'] is None:
+                self.admin_query("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(row['name'], row['table'], row['columns']))
+
+        return self.index_report()
+
+
+    def analyze(self):
+        """
+        Update the statistics the query planner uses, run after bulk loads
+        """
+        self.admin_query("ANALYZE")
+
+
+    def explain(self, query, params = None):
+        """
+        Query plan of a query, i.e. to check that an index is used
+
+        Parameters:
+        query (string): sql query, parameters as :name
+        params (dict): values of the bound parameters in the query
+
+        Returns:
+        pandas dataframe with the plan (detail column: SCAN = full table
+        scan, SEARCH = index lookup)
+        """
+        return self.output_query("EXPLAIN QUERY PLAN " + query, params = {} if params is None else params)
+
+
+    @timed('query_country_data')
+    def get_coutry_data(self, start_date = '2020-02-01'):
+        """
+        Cases per country & day, incl. global totals (country 'total'), read
+        from the daily_stats table maintained by update_db
+        """
+        columns = ['country', 'date', 'confirmed', 'deaths', 'recovered',
+                   'confirmed_scaled', 'deaths_scaled',
+                   'daily_confirmed', 'daily_deaths', 'daily_recovered',
+                   'daily_confirmed_ma7', 'daily_deaths_ma7', 'daily_recovered_ma7',
+                   'conf_group']
+        return self.select('daily_stats', columns, where = 'date >= :start_date',
+                           params = {'start_date' : start_date},
+                           order_by = ['date', 'country'])
+
+
+    @timed('query_top10_countries')
+    def get_top10_countries(self, start_date = '2020-02-01'):
         query = """
                 SELECT date,
                        continent,
@@ -115,13 +350,14 @@ class queryDB:
                   FROM stats
                        JOIN populations
                          ON stats.country = populations.country
-                 WHERE date >= '2020-02-01'
+                 WHERE date >= :start_date
                  WINDOW continent_totals AS (PARTITION BY date, continent)
-                 ORDER BY date, conf_rnk""" # dynamic start-date!?
-        return self.output_query(query)
+                 ORDER BY date, conf_rnk"""
+        return self.output_query(query, params = {'start_date' : start_date}, dtypes = column_dtypes)
 
 
-    def get_exp_data(self):
+    @timed('query_exp_data')
+    def get_exp_data(self, start_date = '2020-01-25'):
         query = """
                 /* main data: confirmed & daily new. optional: got to weekly
                 data, i.e. each Sunday when this becomes to granular */
@@ -148,28 +384,56 @@ class queryDB:
                            conf_rnk,
                            MIN(conf_rnk) OVER (PARTITION BY country ORDER BY date ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) AS min_rnk
                       FROM exp_data
-                     WHERE date >= '2020-01-25')
-
-               /* for multiline in bokeh we need all points per country.
-               for quick plotting, we're pre-processing this by day (all points
-               up till that date) in a string_agg (ideally would be array_agg)*/
-                SELECT today.continent,
-                       today.country,
-                       today.date,
-                       MIN(today.conf_rnk) AS conf_rnk,
-                       MIN(today.min_rnk) AS min_rnk,
-                       group_concat(past.confirmed) AS confirmed,
-                       MAX(past.confirmed) AS confirmedmax,
-                       group_concat(past.new_last_week) AS new_last_week,
-                       MAX(past.new_last_week) AS new_last_weekmax
-                  FROM relevant_data AS today
-                       JOIN relevant_data AS past
-                         ON today.date >= past.date
-                         AND today.country = past.country
-                 WHERE today.min_rnk <= 10
-                 GROUP BY today.continent,
-                          today.country,
-                          today.date
-                 ORDER BY today.country,
-                          today.date"""
-        return self.output_query(query)
+                     WHERE date >= :start_date)
+
+               /* for multiline in bokeh we need all points per country up till
+               each date, these are build from this single series per country
+               in prep_exp_plot (prefix slices, no self-join required) */
+                SELECT continent,
+                       country,
+                       date,
+                       conf_rnk,
+                       min_rnk,
+                       confirmed,
+                       new_last_week
+                  FROM relevant_data
+                 WHERE min_rnk <= 10
+                 ORDER BY country,
+                          date"""
+        return self.output_query(query, params = {'start_date' : start_date}, dtypes = column_dtypes)
+
+
+class SharedDB:
+    """
+    The queryDB of the process, shared by the data pipeline (refresher
+    thread) and the dashboard modules. The engine is created on first use,
+    such that importing a module doesn't connect to the DB. Attributes are
+    those of the queryDB.
+
+    Parameters:
+    driver (string): sqlalchemy driver, i.e. 'sqlite'
+    filename (string): DB file
+    """
+    def __init__(self, driver, filename):
+        self.driver = driver
+        self.filename = filename
+        self._db = None
+        self._lock = threading.Lock()
+
+
+    def get(self):
+        """
+        The queryDB, created on the first call
+        """
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    self._db = queryDB(self.driver, self.filename)
+        return self._db
+
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+qdb = SharedDB('sqlite', db_file)
@@ -0,0 +1,189 @@
+import os
+import threading
+import pandas as pd
+
+from src.data.process_data import update_db, download_update, update_daily_stats, data_folder, qdb
+from src.data.artifact_cache import file_lock
+from src.data import shared_datasets
+
+
+class DBRefresher:
+    """
+    Run update_db in a background thread on a fixed interval, such that the
+    dashboard doesn't wait for the upstream data. A file lock ensures only a
+    single process (bokeh worker) updates the DB at a time. Listeners are
+    called when the data version changes (new or revised dates).
+
+    Parameters:
+    interval (int): seconds between updates (default = 1 hour)
+    lock_file (string): file used to lock the DB between processes
+    update (bool): update the DB, False to only watch for new dates (i.e. the
+                   workers of a multi-process deployment, where the loader
+                   process updates the DB)
+    version (function): returns the current version, default the version
+                        of the DB (queryDB.data_version)
+    revise_days (int): re-ingest the last days in the DB on every update,
+                       such that days revised upstream are picked up, 0 to
+                       only add new days
+    """
+    def __init__(self, interval = 3600, lock_file = None, update = True, version = None, revise_days = 14):
+        self.interval = interval
+        self.lock_file = data_folder + 'processed/update_db.lock' if lock_file is None else lock_file
+        self.update = update
+        self.version = version
+        self.revise_days = revise_days
+        self.last_version = None
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def add_listener(self, callback):
+        """
+        Call callback (without arguments, from the refresh thread) once the
+        data version changes. Bokeh sessions should use doc.add_next_tick_callback
+        in callback to update their document.
+        """
+        with self._lock:
+            self._listeners.append(callback)
+
+
+    def remove_listener(self, callback):
+        """
+        Stop calling callback, i.e. once a session is destroyed
+        """
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+
+    def db_lock(self, blocking = True):
+        """
+        Lock the DB for writing between processes
+
+        Parameters:
+        blocking (bool): wait for the lock, else give up if already locked
+
+        Returns:
+        context manager yielding whether the lock was acquired
+        """
+        return file_lock(self.lock_file, blocking)
+
+
+    def current_version(self):
+        """
+        Version of the data in the DB (or of the version function)
+        """
+        if self.version is not None:
+            return self.version()
+        return qdb.data_version()
+
+
+    def revise_from(self):
+        """
+        First date re-ingested by an update: the last revise_days days in the
+        stats table
+
+        Returns:
+        date (string, yyyy-mm-dd), None to only add new days
+        """
+        last_date = qdb.output_query("SELECT MAX(date) FROM stats").iloc[0][0]
+        if self.revise_days <= 0 or last_date is None:
+            return None
+        return (pd.Timestamp(last_date) - pd.Timedelta(days = self.revise_days - 1)).strftime('%Y-%m-%d')
+
+
+    def refresh(self):
+        """
+        Update the DB, unless another process is doing so, and notify the
+        listeners when the data changed (by this or another process). The
+        download is done before locking the DB, such that other processes
+        only wait for the DB write.
+
+        Returns:
+        True if the data version changed
+        """
+        if self.update:
+            try:
+                from_date = self.revise_from()
+                update_df = download_update(from_date)
+            except Exception as e:
+                update_df = None
+                print('unable to download data')
+                print("---")
+                print(str(e))
+                print("---")
+
+            if update_df is not None:
+                with self.db_lock(blocking = False) as locked:
+                    if locked:
+                        update_db(from_date, update_df)
+
+        version = self.current_version()
+        changed = self.last_version is not None and version is not None and version != self.last_version
+        self.last_version = version
+
+        if changed:
+            with self._lock:
+                listeners = list(self._listeners)
+            for callback in listeners:
+                try:
+                    callback()
+                except Exception as e:
+                    print('unable to notify listener')
+                    print(str(e))
+
+        return changed
+
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                print('unable to refresh db')
+                print("---")
+                print(str(e))
+                print("---")
+            self._stop.wait(self.interval)
+
+
+    def start(self):
+        """
+        Start the refresh thread (first refresh is run immediately). Only
+        ensures daily_stats is complete before returning, which requires no
+        download, and only when the DB isn't locked: the process holding the
+        lock completes daily_stats.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            # data the sessions start with, before any update
+            if self.last_version is None:
+                if self.update:
+                    with self.db_lock(blocking = False) as locked:
+                        if locked:
+                            update_daily_stats()
+                self.last_version = self.current_version()
+
+            self._stop.clear()
+            self._thread = threading.Thread(target = self._run, name = 'db-refresher', daemon = True)
+            self._thread.start()
+
+
+    def stop(self):
+        """
+        Stop the refresh thread after the current refresh
+        """
+        self._stop.set()
+
+
+# single refresher per process, shared by all sessions. Workers of a
+# multi-process deployment only watch for versions published by the loader.
+# COVID_REFRESH=0 only watches the DB as well, i.e. during a load test.
+if shared_datasets.enabled:
+    refresher = DBRefresher(interval = int(os.environ.get('COVID_REFRESH_INTERVAL', 60)), update = False,
+                            version = shared_datasets.shared.current_version)
+else:
+    refresher = DBRefresher(interval = int(os.environ.get('COVID_REFRESH_INTERVAL', 3600)),
+                            update = os.environ.get('COVID_REFRESH', '1') == '1',
+                            revise_days = int(os.environ.get('COVID_REVISE_DAYS', 14)))
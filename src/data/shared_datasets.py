@@ -0,0 +1,262 @@
+import os
+import json
+import shutil
+import threading
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from src.data.artifact_cache import artifacts
+
+# absolute paths, also valid when called outside of src/visualization
+data_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/')
+
+# worker of a multi-process deployment: attach to the datasets of the loader process
+enabled = os.environ.get('COVID_SHARED_DATASETS', '0') == '1'
+
+
+def version_key(version):
+    """
+    Order of data versions: '2020-07-13.4' (last date & counter, see
+    queryDB.data_version) or only the last date for a DB which isn't
+    versioned yet
+
+    Parameters:
+    version: version of the data
+
+    Returns:
+    tuple of the last date (string) and counter (int)
+    """
+    last_date, _, counter = str(version).partition('.')
+    return last_date[:10], int(counter) if counter.isdigit() else 0
+
+
+def write_frame(folder, name, df):
+    """
+    Store a dataframe as one .npy file per column, categoricals as their
+    codes (categories in the returned meta data). Object columns are stored
+    as categoricals.
+
+    Parameters:
+    folder (string): folder to write to
+    name (string): name of the frame
+    df (pandas dataframe): frame to store
+
+    Returns:
+    list with per column its name and categories & ordered for categoricals
+    """
+    columns = []
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == object:
+            values = values.astype('category')
+
+        path = os.path.join(folder, '{}.{}.npy'.format(name, col))
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            np.save(path, values.cat.codes.to_numpy())
+            columns.append({'name' : col,
+                            'categories' : values.cat.categories.tolist(),
+                            'ordered' : bool(values.cat.ordered)})
+        else:
+            np.save(path, values.to_numpy())
+            columns.append({'name' : col})
+
+    return columns
+
+
+def read_frame(folder, name, columns):
+    """
+    Read a dataframe stored by write_frame, memory-mapped: the columns are
+    read-only views on the (shared) page cache, not copies
+
+    Parameters:
+    folder (string): folder to read from
+    name (string): name of the frame
+    columns (list): column meta data returned by write_frame
+
+    Returns:
+    pandas dataframe
+    """
+    data = {}
+    for col in columns:
+        values = np.load(os.path.join(folder, '{}.{}.npy'.format(name, col['name'])), mmap_mode = 'r')
+        if 'categories' in col:
+            values = pd.Categorical.from_codes(values, categories = col['categories'], ordered = col['ordered'])
+        data[col['name']] = values
+
+    # copy = False: a column per block, pandas doesn't consolidate (copy) the arrays
+    return pd.DataFrame(data, copy = False)
+
+
+class SharedDatasets:
+    """
+    Datasets for the workers of a multi-process deployment (bokeh serve
+    --num-procs). A single loader process builds the frames and publishes
+    them as read-only column files; the workers memory-map these files, such
+    that all workers share one copy (the page cache) instead of each running
+    the SQL and holding its own copy.
+
+    A version is published atomically: its files are written to a new
+    folder, after which the CURRENT file is replaced to point to it. Workers
+    pick up the new version on their next lookup.
+
+    get() has the interface of ArtifactCache.get, frames which aren't
+    published (for that version) are built by the fallback.
+
+    Parameters:
+    folder (string): folder to publish in
+    fallback (ArtifactCache): cache used for frames which aren't published
+    keep (int): number of published versions to keep (workers may still be
+                attaching to the previous one)
+    """
+    def __init__(self, folder = None, fallback = None, keep = 2):
+        self.folder = data_folder + 'processed/shared/' if folder is None else folder
+        self.fallback = fallback
+        self.keep = keep
+        self._attached = {}
+        self._lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+
+
+    def current(self):
+        """
+        Currently published version
+
+        Returns:
+        dictionary with the version (of the data in the DB) and key (folder)
+        of the published frames, None if nothing is published
+        """
+        try:
+            with open(os.path.join(self.folder, 'CURRENT')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def current_version(self):
+        """
+        Version of the published data, None if nothing is published
+        """
+        current = self.current()
+        return None if current is None else current['version']
+
+
+    def publish(self, version, frames):
+        """
+        Publish the frames of a version (loader process). Publishes are
+        serialized and only a version newer than the published one is
+        published, such that the workers never go back to older data.
+
+        Parameters:
+        version: version of the data in the DB (queryDB.data_version)
+        frames (dict): name and pandas dataframe
+
+        Returns:
+        key of the published version (string), None if not newer than the
+        published version
+        """
+        with self._publish_lock:
+            published = self.current_version()
+            if published is not None and version_key(version) <= version_key(published):
+                print('not publishing {}, {} is published'.format(version, published))
+                return None
+
+            return self._publish(version, frames)
+
+
+    def _publish(self, version, frames):
+        key = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        tmp = os.path.join(self.folder, '{}.{}.tmp'.format(key, os.getpid()))
+        os.makedirs(tmp)
+
+        meta = {name : write_frame(tmp, name, df) for name, df in frames.items()}
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp, os.path.join(self.folder, key))
+
+        # switch the workers to the new version
+        current = os.path.join(self.folder, 'CURRENT.{}.tmp'.format(os.getpid()))
+        with open(current, 'w') as f:
+            json.dump({'version' : str(version), 'key' : key}, f)
+        os.replace(current, os.path.join(self.folder, 'CURRENT'))
+
+        # remove older versions, files still mapped by a worker remain readable
+        published = sorted(name for name in os.listdir(self.folder) if name.isdigit())
+        for old in published[:-self.keep]:
+            shutil.rmtree(os.path.join(self.folder, old), ignore_errors = True)
+
+        return key
+
+
+    def attach(self, key):
+        """
+        Memory-map the frames of a published version, once per process
+
+        Parameters:
+        key (string): key of the published version
+
+        Returns:
+        dictionary with name and (read-only) pandas dataframe
+        """
+        with self._lock:
+            if key not in self._attached:
+                folder = os.path.join(self.folder, key)
+                with open(os.path.join(folder, 'meta.json')) as f:
+                    meta = json.load(f)
+                # previous versions are released once no session uses them anymore
+                self._attached = {key : {name : read_frame(folder, name, columns)
+                                         for name, columns in meta.items()}}
+
+            return self._attached[key]
+
+
+    def get(self, name, db_version, builder, sources = ()):
+        """
+        Get a published frame, building it (via the fallback) when it isn't
+        published for db_version
+
+        Parameters:
+        name (string): name of the frame
+        db_version: version of the data (queryDB.data_version)
+        builder (function): function without arguments returning the frame
+        sources (list): files the frame depends on (for the fallback)
+
+        Returns:
+        pandas dataframe, read-only when published
+        """
+        current = self.current()
+        if current is not None and current['version'] == str(db_version):
+            try:
+                frames = self.attach(current['key'])
+                if name in frames:
+                    # shallow copy: the loaders may add columns, the arrays stay shared
+                    return frames[name].copy(deep = False)
+            except (OSError, ValueError) as e:
+                print('unable to attach to shared {}: {}'.format(name, e))
+
+        if self.fallback is not None:
+            return self.fallback.get(name, db_version, builder, sources)
+        return builder()
+
+
+class FrameRecorder:
+    """
+    Cache wrapper keeping the frames that are got through it, i.e. to
+    publish the frames the dashboard loaders are built from
+
+    Parameters:
+    cache (ArtifactCache): cache to get the frames from
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.frames = {}
+
+
+    def get(self, name, db_version, builder, sources = ()):
+        df = self.cache.get(name, db_version, builder, sources)
+        # shallow copy: columns the loader adds afterwards are not published
+        self.frames[name] = df.copy(deep = False)
+        return df
+
+
+shared = SharedDatasets(fallback = artifacts)
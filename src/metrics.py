@@ -0,0 +1,216 @@
+"""
+Latency & payload metrics of the dashboard: the pipeline stages (update_db,
+queries, geometry, data prep) and the bokeh callbacks. Off unless
+COVID_PROFILE=1; then available via report(), written to
+COVID_PROFILE_REPORT (json or text) at exit and served on
+http://localhost:COVID_PROFILE_PORT when set.
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+enabled = os.environ.get('COVID_PROFILE', '0') == '1'
+
+# bucket upper bounds of the histograms, per unit
+buckets = {'ms' : [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000],
+           'bytes' : [1e3, 2e3, 5e3, 1e4, 2e4, 5e4, 1e5, 2e5, 5e5, 1e6, 2e6, 5e6, 1e7]}
+
+
+class Histogram:
+    """
+    Distribution of a metric: count, total & counts per bucket over all
+    observations, percentiles over the most recent observations
+
+    Parameters:
+    unit (string): ms or bytes, selects the buckets
+    keep (int): number of recent observations kept for the percentiles
+    """
+    def __init__(self, unit, keep = 10000):
+        self.unit = unit
+        self.bounds = buckets[unit]
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen = keep)
+
+
+    def add(self, value):
+        self.counts[int(np.searchsorted(self.bounds, value))] += 1
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+
+    def summary(self):
+        """
+        Returns:
+        dictionary with unit, count, mean, p50, p95, p99, max and the
+        histogram (bucket upper bound and count, non-empty buckets only)
+        """
+        recent = np.array(self.recent)
+        labels = ['<={:g}'.format(b) for b in self.bounds] + ['>{:g}'.format(self.bounds[-1])]
+        return {'unit' : self.unit,
+                'count' : self.count,
+                'mean' : self.total / self.count,
+                'p50' : float(np.percentile(recent, 50)),
+                'p95' : float(np.percentile(recent, 95)),
+                'p99' : float(np.percentile(recent, 99)),
+                'max' : float(recent.max()),
+                'histogram' : {label : n for label, n in zip(labels, self.counts) if n > 0}}
+
+
+_histograms = {}
+_lock = threading.Lock()
+
+
+def record(name, value, unit = 'ms', force = False):
+    """
+    Record an observation (does nothing unless enabled)
+
+    Parameters:
+    name (string): metric, i.e. stage or callback
+    value (float): observed value
+    unit (string): ms or bytes
+    force (bool): record also when not enabled, i.e. the patch sizes with
+                  COVID_PATCH_STATS=1 (see instrument.measure_patch)
+    """
+    if not enabled and not force:
+        return
+
+    with _lock:
+        key = (name, unit)
+        if key not in _histograms:
+            _histograms[key] = Histogram(unit)
+        _histograms[key].add(value)
+
+
+class timed:
+    """
+    Record the latency of a block or function under name, usable as a
+    context manager (with timed('x'):) and as a decorator (@timed('x'))
+
+    Parameters:
+    name (string): metric to record under
+    """
+    def __init__(self, name):
+        self.name = name
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc):
+        record(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with timed(self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def report(unit = None):
+    """
+    Summary of all recorded metrics
+
+    Parameters:
+    unit (string): only metrics in this unit (ms or bytes), None for all
+
+    Returns:
+    dictionary with per unit a dictionary of metric name and summary
+    """
+    with _lock:
+        summaries = {}
+        for (name, metric_unit), histogram in sorted(_histograms.items()):
+            if unit is None or metric_unit == unit:
+                summaries.setdefault(metric_unit, {})[name] = histogram.summary()
+
+    return summaries
+
+
+def report_text():
+    """
+    Report as a plain text table, one line per metric
+    """
+    lines = ['{:<24} {:>6} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+             'metric', 'unit', 'count', 'mean', 'p50', 'p95', 'p99', 'max')]
+    for unit, summaries in report().items():
+        for name, s in summaries.items():
+            lines.append('{:<24} {:>6} {:>7} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                         name, unit, s['count'], s['mean'], s['p50'], s['p95'], s['p99'], s['max']))
+
+    return '\n'.join(lines)
+
+
+def save_report(path):
+    """
+    Write the report to a file, as json unless the file ends with .txt
+
+    Parameters:
+    path (string): file to write to
+    """
+    with open(path, 'w') as f:
+        if path.endswith('.txt'):
+            f.write(report_text() + '\n')
+        else:
+            json.dump(report(), f, indent = 2)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serve the report: /metrics.txt as text, anything else as json
+    """
+    def do_GET(self):
+        text = self.path.endswith('.txt')
+        body = (report_text() if text else json.dumps(report(), indent = 2)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain' if text else 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host = 'localhost'):
+    """
+    Serve the report on a local port, in a background (daemon) thread
+
+    Parameters:
+    port (int): port to listen on
+    host (string): interface to listen on (default: local only)
+
+    Returns:
+    the http server, None if the port is in use (i.e. by another worker)
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print('metrics endpoint not started on port {}: {}'.format(port, e))
+        return None
+
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    print('metrics on http://{}:{}/metrics'.format(host, port))
+    return server
+
+
+# export when configured, once per process
+if enabled and os.environ.get('COVID_PROFILE_REPORT'):
+    atexit.register(save_report, os.environ['COVID_PROFILE_REPORT'])
+if enabled and os.environ.get('COVID_PROFILE_PORT'):
+    start_metrics_server(int(os.environ['COVID_PROFILE_PORT']))
@@ -0,0 +1,289 @@
+"""
+Client-side animation: all per-date frames are send to the browser once, as
+compact typed arrays (one flat array per value, frame i at [i*n, (i+1)*n)),
+after which the slider and Play button are handled in javascript, without
+a server round-trip per frame.
+"""
+
+import numpy as np
+import pandas as pd
+
+from bokeh.models import ColumnDataSource, CustomJS
+
+from src.visualization.prepare_dashboard_data import get_country_colormap
+
+# javascript helpers shared by the callbacks
+JS_FRAME_INDEX = """
+    // frame for the slider value: last date <= value (dates in ms)
+    const dates = frames.data.dates[0]
+    let i = 0
+    while (i + 1 < dates.length && dates[i + 1] <= slider.value + 43200000) {
+        i++
+    }
+"""
+
+JS_PLAY = """
+    // advance the slider every 200ms, back to the start after the end
+    if (button.label == '► Play') {
+        button.label = '❚❚ Pause'
+        button._animation = setInterval(function() {
+            let value = slider.value + 86400000
+            if (value > slider.end) {
+                value = start
+            }
+            slider.value = value
+        }, 200)
+    } else {
+        button.label = '► Play'
+        clearInterval(button._animation)
+    }
+"""
+
+
+def to_ms(dates):
+    """
+    Convert dates to ms since epoch (how bokeh sends dates to the browser)
+    """
+    return pd.to_datetime(pd.Series(dates)).to_numpy().astype('datetime64[ms]').astype('float64')
+
+
+def pivot_frames(df, columns, values, dates, fill, dtype):
+    """
+    Pivot a long dataframe to a flat array with one frame per date
+
+    Parameters:
+    df (pandas dataframe): data with (at least) date, columns & values
+    columns (string): column identifying the rows within a frame
+    values (string): column to pivot
+    dates (list): dates of the frames
+    fill: value for missing rows
+    dtype: dtype of the flat array
+
+    Returns:
+    tuple of flat numpy array (dates x rows) and the row labels
+    """
+    wide = df.assign(**{columns : df[columns].astype(str)}) \
+             .pivot(index = 'date', columns = columns, values = values) \
+             .reindex(index = dates)
+    return wide.fillna(fill).to_numpy().astype(dtype).ravel(), list(wide.columns)
+
+
+def country_frames(plot_data, country_order):
+    """
+    Map frames for the country tab: color class (0 = no data, 1-9 palette)
+    and values per country (geometry order) for every date
+
+    Parameters:
+    plot_data (pandas dataframe): output of country_plot_data
+    country_order (list): countries in order of the geometry source
+
+    Returns:
+    dictionary with one-row columns, data for a bokeh ColumnDataSource
+    """
+    dates = np.sort(plot_data['date'].unique())
+    classes = {color : i + 1 for i, color in enumerate(get_country_colormap().values())}
+    data = plot_data.assign(color_class = plot_data['color'].astype(object).map(classes).fillna(0),
+                            country = plot_data['country'].astype(str))
+    wide = lambda values, fill: data.pivot(index = 'date', columns = 'country', values = values) \
+                                    .reindex(index = dates, columns = country_order) \
+                                    .fillna(fill).to_numpy().ravel()
+
+    return {'dates' : [to_ms(dates)],
+            'color_class' : [wide('color_class', 0).astype('uint8')],
+            'confirmed_scaled' : [wide('confirmed_scaled', np.nan).astype('float32')],
+            'deaths_scaled' : [wide('deaths_scaled', np.nan).astype('float32')]}
+
+
+def add_country_animation(frames, slider, button, start, geosource, source, view, spans, map_plot):
+    """
+    Animate the country tab in the browser: on a slider change update the
+    map colors, the highlighted date in the lineplots and the title.
+
+    Parameters:
+    frames (dict): output of country_frames
+    slider (DateSlider): date slider
+    button (Button): play button
+    start (datetime): date to restart the animation from
+    geosource (ColumnDataSource): map source
+    source (ColumnDataSource): source of the lineplots, with a date column
+    view (CDSView): view with an IndexFilter highlighting the date in source
+    spans (list): Span's marking the date in the lineplots
+    map_plot (figure): map, for the title
+    """
+    palette = ['#d9d9d9'] + list(get_country_colormap().values())
+    args = dict(frames = ColumnDataSource(frames), slider = slider, geosource = geosource,
+                source = source, view = view, spans = spans, map_plot = map_plot, palette = palette)
+
+    slider.js_on_change('value', CustomJS(args = args, code = JS_FRAME_INDEX + """
+        // map colors & values of frame i
+        const n = geosource.data.country.length
+        const classes = frames.data.color_class[0]
+        const color = new Array(n)
+        for (let j = 0; j < n; j++) {
+            color[j] = palette[classes[i * n + j]]
+        }
+        geosource.data.color = color
+        geosource.data.confirmed_scaled = frames.data.confirmed_scaled[0].slice(i * n, (i + 1) * n)
+        geosource.data.deaths_scaled = frames.data.deaths_scaled[0].slice(i * n, (i + 1) * n)
+        geosource.change.emit()
+
+        // highlight the date in the lineplots
+        for (const span of spans) {
+            span.location = dates[i]
+        }
+        const k = Array.from(source.data.date).indexOf(dates[i])
+        view.filters[0].indices = k >= 0 ? [k] : []
+
+        const day = new Date(dates[i]).toISOString().slice(0, 10)
+        map_plot.title.text = 'Covid cases per 1 Million inhabitants on ' + day +
+                              ' (click on a country to see more details)'
+    """))
+
+    button.js_on_click(CustomJS(args = dict(button = button, slider = slider, start = to_ms([start])[0]),
+                                code = JS_PLAY))
+
+
+def growth_frames(top10_countries, cont_bars, exp_data, continents):
+    """
+    Frames for the growth tab: top-10 bars, continent bars and growth lines
+    for every date. The growth lines are send as one series per country, a
+    frame only holds the number of points shown per country.
+
+    Parameters:
+    top10_countries (pandas dataframe): top-10 countries per date
+    cont_bars (pandas dataframe): totals per continent & date
+    exp_data (pandas dataframe): output of prep_exp_plot
+    continents (dict): continent and color, in plotting order
+
+    Returns:
+    dictionary with one-row columns, data for a bokeh ColumnDataSource
+    """
+    dates = np.sort(top10_countries['date'].unique())
+
+    # top-10: country (index in names), cases & color per rank
+    names = sorted(top10_countries['country'].astype(str).unique())
+    top10 = top10_countries.assign(name = top10_countries['country'].astype(str).map({n : i for i, n in enumerate(names)}),
+                                   rank = top10_countries['conf_rnk'].astype(str))
+    top10_name, ranks = pivot_frames(top10, 'rank', 'name', dates, -1, 'int16')
+    order = np.argsort([int(r) for r in ranks])
+    frame = lambda values: pivot_frames(top10, 'rank', values, dates, 0, 'float64')[0].reshape(len(dates), -1)[:, order].ravel()
+    name_color = top10.drop_duplicates('name').set_index('name')['color'].astype(str).reindex(range(len(names)))
+    name_continent = top10.drop_duplicates('name').set_index('name')['continent'].astype(str).reindex(range(len(names)))
+
+    # continents in plotting order
+    cont = cont_bars.assign(continent = pd.Categorical(cont_bars['continent'].astype(str), categories = list(continents)))
+    cont_frame = lambda values: cont.pivot(index = 'date', columns = 'continent', values = values) \
+                                    .reindex(index = dates, columns = list(continents)) \
+                                    .fillna(0).to_numpy().ravel()
+
+    # growth lines: full series per country (last row), points shown per date
+    exp = exp_data.assign(country = exp_data['country'].astype(str))
+    last = exp.sort_values('date').groupby('country').tail(1).sort_values('country')
+    counts = exp.assign(points = exp['confirmed'].map(len)) \
+                .pivot(index = 'date', columns = 'country', values = 'points') \
+                .reindex(columns = last['country']).reindex(index = dates).fillna(0)
+    top = exp.assign(top10 = exp['conf_rnk'] <= 10) \
+             .pivot(index = 'date', columns = 'country', values = 'top10') \
+             .reindex(columns = last['country']).reindex(index = dates).fillna(False)
+
+    return {'dates' : [to_ms(dates)],
+            'top10_name' : [top10_name.reshape(len(dates), -1)[:, order].ravel()],
+            'top10_confirmed' : [frame('confirmed').astype('int32')],
+            'top10_deaths' : [frame('deaths').astype('int32')],
+            'top10_recovered' : [frame('recovered').astype('int32')],
+            'names' : [names],
+            'name_color' : [name_color.tolist()],
+            'name_continent' : [name_continent.tolist()],
+            'continents' : [list(continents)],
+            'continent_colors' : [list(continents.values())],
+            'cont_confirmed' : [cont_frame('confirmed_continent').astype('int32')],
+            'cont_deaths' : [cont_frame('deaths_continent').astype('int32')],
+            'cont_recovered' : [cont_frame('recovered_continent').astype('int32')],
+            'exp_country' : [last['country'].tolist()],
+            'exp_continent' : [last['continent'].astype(str).tolist()],
+            'exp_color' : [last['color'].astype(str).tolist()],
+            'exp_confirmed' : [list(last['confirmed'])],
+            'exp_new_last_week' : [list(last['new_last_week'])],
+            'exp_points' : [counts.to_numpy().astype('int16').ravel()],
+            'exp_top10' : [top.to_numpy().astype('uint8').ravel()]}
+
+
+def add_growth_animation(frames, slider, button, start, top10_source, cont_source, exp_source, top10_plot,
+                         main_alpha = 1.0, non_selection_alpha = 0.2):
+    """
+    Animate the growth tab in the browser: on a slider change update the
+    top-10 bars (and axis), continent bars and growth lines.
+
+    Parameters:
+    frames (dict): output of growth_frames
+    slider (DateSlider): date slider
+    button (Button): play button
+    start (datetime): date to restart the animation from
+    top10_source, cont_source, exp_source (ColumnDataSource): plot sources
+    top10_plot (figure): top-10 barplot, for the axis (factors)
+    main_alpha (float): alpha of top-10 countries in the growth plot
+    non_selection_alpha (float): alpha of the other countries
+    """
+    args = dict(frames = ColumnDataSource(frames), slider = slider, top10_source = top10_source,
+                cont_source = cont_source, exp_source = exp_source, top10_plot = top10_plot,
+                main_alpha = main_alpha, non_selection_alpha = non_selection_alpha)
+
+    slider.js_on_change('value', CustomJS(args = args, code = JS_FRAME_INDEX + """
+        const f = frames.data
+
+        // replace all columns of a source in place (no sync to the server)
+        function set_data(source, data) {
+            for (const key of Object.keys(source.data)) {
+                delete source.data[key]
+            }
+            Object.assign(source.data, data)
+            source.change.emit()
+        }
+
+        // top-10 bars, skip empty ranks
+        const n = f.top10_name[0].length / dates.length
+        const top10 = {country: [], continent: [], color: [], confirmed: [], deaths: [], recovered: []}
+        for (let j = i * n; j < (i + 1) * n; j++) {
+            const name = f.top10_name[0][j]
+            if (name < 0) {
+                continue
+            }
+            top10.country.push(f.names[0][name])
+            top10.continent.push(f.name_continent[0][name])
+            top10.color.push(f.name_color[0][name])
+            top10.confirmed.push(f.top10_confirmed[0][j])
+            top10.deaths.push(f.top10_deaths[0][j])
+            top10.recovered.push(f.top10_recovered[0][j])
+        }
+        set_data(top10_source, top10)
+        top10_plot.y_range.factors = top10.country.slice().reverse()
+
+        // continent bars
+        const m = f.continents[0].length
+        set_data(cont_source, {
+            continent: f.continents[0],
+            color: f.continent_colors[0],
+            confirmed_continent: f.cont_confirmed[0].slice(i * m, (i + 1) * m),
+            deaths_continent: f.cont_deaths[0].slice(i * m, (i + 1) * m),
+            recovered_continent: f.cont_recovered[0].slice(i * m, (i + 1) * m)})
+
+        // growth lines: the first points of each country's series
+        const c = f.exp_country[0].length
+        const exp = {country: [], continent: [], color: [], alpha: [], confirmed: [], new_last_week: []}
+        for (let j = 0; j < c; j++) {
+            const points = f.exp_points[0][i * c + j]
+            if (points == 0) {
+                continue
+            }
+            exp.country.push(f.exp_country[0][j])
+            exp.continent.push(f.exp_continent[0][j])
+            exp.color.push(f.exp_color[0][j])
+            exp.alpha.push(f.exp_top10[0][i * c + j] ? main_alpha : non_selection_alpha)
+            exp.confirmed.push(f.exp_confirmed[0][j].slice(0, points))
+            exp.new_last_week.push(f.exp_new_last_week[0][j].slice(0, points))
+        }
+        set_data(exp_source, exp)
+    """))
+
+    button.js_on_click(CustomJS(args = dict(button = button, slider = slider, start = to_ms([start])[0]),
+                                code = JS_PLAY))
@@ -1,73 +1,99 @@
 import numpy as np
 import pandas as pd
-import geopandas as gpd
-import json
-from datetime import date, datetime
+from datetime import datetime
 
-from src.data.process_data import update_db
-from src.visualization.prepare_dashboard_data import get_country_colormap, country_plot_data, prep_geojson
-from src.data.quick_queries import queryDB
-qdb = queryDB('sqlite','../../data/processed/covid_db.sqlite')
+from src.visualization.dashboard_data import store
+from src.visualization.prepare_dashboard_data import update_source
+from src.visualization.instrument import measure_patch
+from src.visualization.client_animation import add_country_animation
+from src.metrics import timed
 
 from bokeh.io import curdoc
-from bokeh.plotting import figure, show
-from bokeh.models import ColumnDataSource, GeoJSONDataSource, NumeralTickFormatter, HoverTool, TapTool, DateSlider, Button, CDSView, BooleanFilter, Span
-from bokeh.palettes import brewer
+from bokeh.plotting import figure
+from bokeh.models import ColumnDataSource, NumeralTickFormatter, HoverTool, TapTool, WheelZoomTool, PanTool, DateSlider, Button, CDSView, IndexFilter, Span
+from bokeh.events import RangesUpdate
 from bokeh.layouts import row, column
 
-def country_tab():
+@timed('country_tab')
+def country_tab(client_animation = False):
     """
     Plots for the country tab, showing Covid Spread on a map.
     Details behind the plots in notebook/plots/0_country_status.ipynb
+
+    Parameters:
+    client_animation (bool): run the slider & animation in the browser on
+                             preloaded frames instead of via the server
     """
-    #### Get and prepare datasources
-    df = qdb.get_coutry_data()
-    countries = gpd.read_file("../../data/processed/countries.shp")
-    plot_data = country_plot_data(df, countries)
+    #### Get datasources, shared with other sessions (don't modify)
+    data = store.get('country')
+    df = data['df']
+    geometry_tiers = data['geometry_tiers']
+    map_cache = data['map_cache']
+    by_country = data['by_country']
+    bounds = data['bounds']
 
 
     #### starting variables
     start_date = '2020-03-10' #'2020-02-01'
-    first_date = df['date'].min()
-    end_date = df['date'].max()
+    first_date = df['date'].min().strftime("%Y-%m-%d")
+    end_date = df['date'].max().strftime("%Y-%m-%d")
 
     # show totals by default (obtained via rollup with 'total' in country)
     country = 'total'
 
-    # convert date to datetime for plotting with temporal axis
-    df['date_obj'] = pd.to_datetime(df['date'])
-
     # colorscheme (red, black, blue) for consistent use
     color_scheme = {'confirmed' : '#bf4040',
                     'deaths' : '#868f96',
                     'recovered' : '#a4d5fc'}
 
-    # plot sources
-    geosource = GeoJSONDataSource(geojson = prep_geojson(plot_data, start_date))
-    source = ColumnDataSource(df[df['country']==country])
-    booleans = [True if date == start_date else False for date in source.data['date']]
-    view = CDSView(source=source, filters = [BooleanFilter(booleans)])
-    #source_hl = ColumnDataSource(df[(df['country']==country)
-    #                                    & (df['date'] == start_date)])
+    # level of detail: coarse geometry by default, finer when zoomed in
+    # (map width in degrees below which a tier is used) or for a selected country.
+    # The fine tier is only send for the countries in view.
+    tier_widths = {'medium' : 120, 'fine' : 30}
+    n_countries = len(geometry_tiers['coarse']['country'])
+    geometry_state = {'tier' : 'coarse', 'selected' : None,
+                      'in_view' : np.ones(n_countries, dtype = bool),
+                      'shown' : ['coarse'] * n_countries}
+
+    # plot sources: geometry is send once, afterwards only the colors change
+    # (copies: the colors are patched, leave the shared data untouched)
+    map_data = {col : np.array(v) for col, v in map_cache.get(start_date).items()}
+    geosource = ColumnDataSource(dict(geometry_tiers['coarse'], **map_data))
+
+    # country per feature (row) of geosource, for map taps
+    feature_country = geometry_tiers['coarse']['country']
+
+    # line & bar plots: data of the selected country (countries on the map without data show nothing)
+    no_data = {col : values[:0] for col, values in by_country[country].items()}
+    source = ColumnDataSource(dict(by_country[country]))
+
+    # highlight the selected date in the lineplots by its index in source
+    def date_index(select_date):
+        dates = source.data['date']
+        i = int(np.searchsorted(dates, np.datetime64(select_date)))
+        return [i] if i < len(dates) and dates[i] == np.datetime64(select_date) else []
+
+    view = CDSView(source=source, filters = [IndexFilter(date_index(start_date))])
 
     #### interactive elements
+    @timed('country_slider')
     def update_slider(attr, old, new):
         # changes to listen for
         dt = date_slider.value
         select_date = datetime.fromtimestamp(dt/1000).strftime("%Y-%m-%d")
 
-        # get data for this new date
-        geosource.geojson = prep_geojson(plot_data, select_date)
+        with measure_patch(date_slider.document, 'country_slider'):
+            # get data for this new date, only sending the changed colors
+            update_source(geosource, map_cache.get(select_date), None)
 
-        # update our view to highlight this data in the lineplots
-        cur_date.location = datetime.strptime(select_date, "%Y-%m-%d")
-        cur_date_dy.location = datetime.strptime(select_date, "%Y-%m-%d")
-        booleans = [True if date == select_date else False for date in source.data['date']]
-        view.filters[0] = BooleanFilter(booleans)
+            # update our view to highlight this data in the lineplots
+            cur_date.location = datetime.strptime(select_date, "%Y-%m-%d")
+            cur_date_dy.location = datetime.strptime(select_date, "%Y-%m-%d")
+            view.filters[0].indices = date_index(select_date)
 
-        # update title
-        map_plot.title.text = "Covid cases per 1 Million inhabitants on {} \
-                (click on a country to see more details)".format(select_date)
+            # update title
+            map_plot.title.text = "Covid cases per 1 Million inhabitants on {} \
+                    (click on a country to see more details)".format(select_date)
     # update slider during animation
     def animate_update():
         dt = date_slider.value + (3600*24*1000) #1 day in seconds
@@ -76,9 +102,10 @@ def country_tab():
             dt_formatted = start_date #date(2020, 3, 1).strftime("%Y-%m-%d")
         date_slider.value = datetime.strptime(dt_formatted, "%Y-%m-%d")
 
-    # run the animation
+    # run the animation (callback per session, a module global is shared by all sessions)
+    callback_id = None
     def animate():
-        global callback_id
+        nonlocal callback_id
         if button.label == '► Play':
             button.label = '❚❚ Pause'
             # second parameter is the step-time in ms
@@ -87,16 +114,78 @@ def country_tab():
             button.label = '► Play'
             curdoc().remove_periodic_callback(callback_id)
 
+    # tier of a country: fine for the selected country, the tier of the zoom
+    # otherwise, except that the fine tier is only used for countries in view
+    # (medium for the rest)
+    def country_tier(indx):
+        if indx == geometry_state['selected']:
+            return 'fine'
+        if geometry_state['tier'] == 'fine' and not geometry_state['in_view'][indx]:
+            return 'medium'
+        return geometry_state['tier']
+
+    # send the geometry of the countries whose tier changed. A patch is send
+    # as json, replacing the columns as binary buffers (about 4x smaller per
+    # point): only patch when the changed countries are a small part of the map
+    def update_geometry(indices):
+        shown = geometry_state['shown']
+        changed = [(i, tier) for i, tier in ((i, country_tier(i)) for i in indices) if tier != shown[i]]
+        if len(changed) == 0:
+            return
+
+        for i, tier in changed:
+            shown[i] = tier
+        points = lambda countries: sum(len(geometry_tiers[tier]['xs'][i]) for i, tier in countries)
+        if points(changed) * 4 > points(enumerate(shown)):
+            geosource.data.update(xs = [geometry_tiers[tier]['xs'][i] for i, tier in enumerate(shown)],
+                                  ys = [geometry_tiers[tier]['ys'][i] for i, tier in enumerate(shown)])
+        else:
+            geosource.patch({'xs' : [(i, geometry_tiers[tier]['xs'][i]) for i, tier in changed],
+                             'ys' : [(i, geometry_tiers[tier]['ys'][i]) for i, tier in changed]})
+
+    # select a country: only send the fine geometry of that country
+    def select_geometry(indx):
+        previous, geometry_state['selected'] = geometry_state['selected'], indx
+        update_geometry([i for i in dict.fromkeys([previous, indx]) if i is not None])
+
+    # zoom & pan: switch tier on the width of the shown map, fine for the countries in view
+    @timed('country_zoom')
+    def update_tier(event):
+        width = event.x1 - event.x0
+        tier = 'coarse'
+        for name, max_width in tier_widths.items():
+            if width < max_width:
+                tier = name
+
+        # countries with a part (bounds: country, x0, y0, x1, y1) in view
+        in_view = ~((bounds[:, 3] < event.x0) | (bounds[:, 1] > event.x1) |
+                    (bounds[:, 4] < event.y0) | (bounds[:, 2] > event.y1))
+        geometry_state['tier'] = tier
+        geometry_state['in_view'] = np.zeros(n_countries, dtype = bool)
+        geometry_state['in_view'][bounds[in_view, 0].astype(int)] = True
+
+        with measure_patch(map_plot.document, 'country_zoom'):
+            update_geometry(range(n_countries))
+
+    @timed('country_select')
     def function_geosource(attr, old, new):
+        with measure_patch(geosource.document, 'country_select'):
+            select_country()
+
+    def select_country():
         try:
             indx = geosource.selected.indices[0]
-            cntry = json.loads(geosource.geojson)['features'][indx]['properties']['country']
-            source.data = df[df['country'] == cntry]
+            select_geometry(indx)
+            cntry = feature_country[indx]
+            source.data = dict(by_country.get(cntry, no_data))
+            view.filters[0].indices = date_index(date_slider.value_as_date.strftime("%Y-%m-%d"))
             overall_plot.title.text = 'Total cases to date: ' + cntry
             daily_plot.title.text = 'Daily new cases: ' + cntry
 
         except Exception as e:
-            source.data = df[df['country'] == 'total']
+            select_geometry(None)
+            source.data = dict(by_country['total'])
+            view.filters[0].indices = date_index(date_slider.value_as_date.strftime("%Y-%m-%d"))
             overall_plot.title.text = 'Total cases to date: global'
             daily_plot.title.text = 'Daily new cases: global'
             pass
@@ -108,11 +197,14 @@ def country_tab():
     date_slider = DateSlider(title = "Date: ", start = datetime.strptime(first_date, '%Y-%m-%d'),
                              end = slider_end, value = datetime.strptime(start_date, '%Y-%m-%d'),
                              step=1)
-    date_slider.on_change('value', update_slider)
 
     # play button - 'animate'
     button = Button(label='► Play', width=60)
-    button.on_click(animate)
+
+    # client-side the callbacks are added once the plots exist (see below)
+    if not client_animation:
+        date_slider.on_change('value', update_slider)
+        button.on_click(animate)
 
     # taptool: click on country 'function_geosource'
     geosource.selected.on_change('indices', function_geosource)
@@ -124,6 +216,7 @@ def country_tab():
                                 ('infected per 1M','@confirmed_scaled'),
                                 ('deaths per 1M','@deaths_scaled')])
     tap = TapTool()
+    wheel_zoom = WheelZoomTool()
 
     # create the plot
     map_plot = figure(title = "Covid cases per 1 Million inhabitants on {} \
@@ -132,8 +225,10 @@ def country_tab():
                plot_width = 850,
                x_range = [-181,181],
                y_range = [-60,90],
-               tools = [hover, tap],
+               tools = [hover, tap, wheel_zoom, PanTool()],
                toolbar_location = None)
+    map_plot.toolbar.active_scroll = wheel_zoom
+    map_plot.on_event(RangesUpdate, update_tier)
 
     map_plot.patches('xs','ys', source = geosource, fill_color = 'color',
               line_color = 'black', line_width = 0.25, fill_alpha = 1,
@@ -156,11 +251,11 @@ def country_tab():
                toolbar_location = None)
 
     # overall trend
-    overall_plot.line(x='date_obj', y='confirmed', line_width=2, source=source,
+    overall_plot.line(x='date', y='confirmed', line_width=2, source=source,
                       color=color_scheme['confirmed'], legend_label='confirmed')
-    overall_plot.line(x='date_obj', y='deaths', line_width=2, source=source,
+    overall_plot.line(x='date', y='deaths', line_width=2, source=source,
                       color=color_scheme['deaths'], legend_label = 'death')
-    overall_plot.line(x='date_obj', y='recovered', line_width=2, source=source,
+    overall_plot.line(x='date', y='recovered', line_width=2, source=source,
                       color=color_scheme['recovered'], legend_label = 'recovered')
 
     # highlight specific date: vertical line
@@ -169,11 +264,11 @@ def country_tab():
                     line_width=5)
     overall_plot.add_layout(cur_date)
     # and points
-    overall_plot.circle(x = 'date_obj', y = 'confirmed', size = 10, fill_alpha = 1,
+    overall_plot.circle(x = 'date', y = 'confirmed', size = 10, fill_alpha = 1,
                         source = source, view=view, color = color_scheme['confirmed'])
-    overall_plot.circle(x = 'date_obj', y = 'deaths', size = 10, fill_alpha = 1,
+    overall_plot.circle(x = 'date', y = 'deaths', size = 10, fill_alpha = 1,
                         source = source, view=view, color = color_scheme['deaths'])
-    overall_plot.circle(x = 'date_obj', y = 'recovered', size = 10, fill_alpha = 1,
+    overall_plot.circle(x = 'date', y = 'recovered', size = 10, fill_alpha = 1,
                         source = source, view=view, color = color_scheme['recovered'])
 
     # format axes
@@ -201,25 +296,25 @@ def country_tab():
                toolbar_location = None)
 
     # confirmed
-    daily_plot.vbar(x='date_obj', width = bar_w, top='daily_confirmed', source=source, color = color_scheme['confirmed'], alpha = 0.1)
-    daily_plot.line(x='date_obj', y='daily_confirmed_ma7', line_width=2 ,source=source, color = color_scheme['confirmed'])
+    daily_plot.vbar(x='date', width = bar_w, top='daily_confirmed', source=source, color = color_scheme['confirmed'], alpha = 0.1)
+    daily_plot.line(x='date', y='daily_confirmed_ma7', line_width=2 ,source=source, color = color_scheme['confirmed'])
     # death
-    daily_plot.vbar(x='date_obj', width = bar_w, top='daily_deaths', source=source, color = color_scheme['deaths'], alpha = 0.3)
-    daily_plot.line(x='date_obj', y='daily_deaths_ma7', line_width=2 ,source=source, color = color_scheme['deaths'])
+    daily_plot.vbar(x='date', width = bar_w, top='daily_deaths', source=source, color = color_scheme['deaths'], alpha = 0.3)
+    daily_plot.line(x='date', y='daily_deaths_ma7', line_width=2 ,source=source, color = color_scheme['deaths'])
     # recovered
     #p.vbar(x='date', width = bar_w, top='daily_recovered', source=source, color = '#a4d5fc', alpha = 0.3, legend_label = 'deaths')
-    daily_plot.line(x='date_obj', y='daily_recovered_ma7', line_width=2 ,source=source, color = color_scheme['recovered'])
+    daily_plot.line(x='date', y='daily_recovered_ma7', line_width=2 ,source=source, color = color_scheme['recovered'])
 
     # highlight specific date
     cur_date_dy = Span(location = datetime.strptime(start_date, "%Y-%m-%d"),
                     dimension='height', line_color='grey', line_alpha = 0.1,
                     line_width=5)
     daily_plot.add_layout(cur_date_dy)
-    daily_plot.circle(x = 'date_obj', y = 'daily_confirmed_ma7', size = 10, fill_alpha = 1,
+    daily_plot.circle(x = 'date', y = 'daily_confirmed_ma7', size = 10, fill_alpha = 1,
                         source = source, view=view, color = color_scheme['confirmed'])
-    daily_plot.circle(x = 'date_obj', y = 'daily_deaths_ma7', size = 10, fill_alpha = 1,
+    daily_plot.circle(x = 'date', y = 'daily_deaths_ma7', size = 10, fill_alpha = 1,
                         source = source, view=view, color = color_scheme['deaths'])
-    daily_plot.circle(x = 'date_obj', y = 'daily_recovered_ma7', size = 10, fill_alpha = 1,
+    daily_plot.circle(x = 'date', y = 'daily_recovered_ma7', size = 10, fill_alpha = 1,
                         source = source, view=view, color = color_scheme['recovered'])
 
     # format axes (leave out legend, use this from overall plot)
@@ -228,6 +323,13 @@ def country_tab():
 
 
 
+    #### client-side animation: all frames send once, no server round-trips
+    if client_animation:
+        add_country_animation(data['frames'], date_slider, button,
+                              datetime.strptime(start_date, "%Y-%m-%d"), geosource, source,
+                              view, [cur_date, cur_date_dy], map_plot)
+
+
     #### Layout
     layout = row(column(map_plot, row(date_slider, button, sizing_mode='scale_width')),
                  column(overall_plot, daily_plot))
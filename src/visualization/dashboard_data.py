@@ -0,0 +1,320 @@
+import sys
+import threading
+import numpy as np
+import pandas as pd
+
+from src.visualization.prepare_dashboard_data import country_plot_data, prep_map_attributes, DateCache, prep_exp_plot, setAxes, partition_by_date, partition_by_country
+from src.visualization.client_animation import country_frames, growth_frames
+from src.data.quick_queries import qdb
+from src.data.process_geometry import geometry_tiers as tier_tolerances, load_geometry_tiers, geometry_frames, tiers_from_frames, part_bounds, tiers_file
+from src.data.artifact_cache import artifacts
+from src.data import shared_datasets
+from src.metrics import timed
+
+# colorscheme per continent used througout all plots
+continent_colors = {'Africa' : '#003f5c',
+                    'Asia' : '#444e86',
+                    'Europe' : '#955196',
+                    'North America' : '#dd5182',
+                    'Oceania' : '#ff6e54',
+                    'South America' : '#ffa600'}
+
+
+def load_geometry(version, cache = None):
+    """
+    Geometry per level of detail (see load_geometry_tiers) from flat frames
+    in the cache, i.e. memory-mapped frames published by the loader process
+
+    Parameters:
+    version: version of the data in the DB (see DatasetStore), key of the cache
+    cache: cache to get the frames from, default artifacts
+
+    Returns:
+    dictionary with per tier a dictionary with columns country, xs and ys
+    """
+    cache = artifacts if cache is None else cache
+
+    # frames of all tiers, built once when one of them isn't cached
+    frames = []
+    def build(tier = None):
+        if len(frames) == 0:
+            frames.extend(geometry_frames(load_geometry_tiers()))
+        return frames[0] if tier is None else frames[1][tier]
+
+    countries = cache.get('geometry_countries', version, build, sources = [tiers_file])
+    points = {tier : cache.get('geometry_' + tier, version, lambda tier = tier: build(tier), sources = [tiers_file])
+              for tier in tier_tolerances}
+
+    return tiers_from_frames(countries, points)
+
+
+def load_country_data(qdb, version, cache = None):
+    """
+    Query and prepare the (read-only) data for the country tab. The query
+    results are cached on disk (see ArtifactCache) for the next process.
+
+    Parameters:
+    qdb (queryDB): connection to the covid DB
+    version: version of the data in the DB (see DatasetStore), key of the cache
+    cache: cache to get the query results from, default artifacts
+
+    Returns:
+    dictionary with df (cases per country & day), plot_data (map colors per
+    country & day), geometry_tiers (map patches per level of detail),
+    geometry (coarse patches, default), bounds (bounding box per part of a
+    country, for the zoom), map_cache (map colors by date), by_country (line
+    & bar plot data per country, for map taps) and frames (all map colors,
+    for the client-side animation)
+    """
+    cache = artifacts if cache is None else cache
+    df = cache.get('country_data', version, qdb.get_coutry_data)
+
+    # simplified geometry per level of detail, same countries (order) in each tier
+    geometry_tiers = load_geometry(version, cache)
+    geometry = geometry_tiers['coarse']
+    # the countries (order) come from the tiers, rebuilt when their sources change
+    plot_data = cache.get('plot_data', version, lambda: country_plot_data(df, geometry),
+                          sources = [tiers_file])
+
+    # map colors per date (slider moves become a lookup). All dates are kept:
+    # Play & the slider go through the dates in order, an LRU smaller than the
+    # history would miss on every date (a few kB per date)
+    map_cache = DateCache(lambda dt: prep_map_attributes(plot_data, geometry['country'], dt))
+
+    # columns of the line & bar plots per country (a map tap becomes a lookup),
+    # sorted by country such that each country is a view on the (shared) frame
+    columns = ['date', 'confirmed', 'deaths', 'recovered',
+               'daily_confirmed', 'daily_deaths', 'daily_recovered',
+               'daily_confirmed_ma7', 'daily_deaths_ma7', 'daily_recovered_ma7']
+    series = cache.get('country_series', version,
+                       lambda: df.sort_values(['country', 'date'], kind = 'stable')[['country'] + columns]
+                                 .reset_index(drop = True))
+    by_country = partition_by_country(series, columns)
+
+    return {'df' : df,
+            'plot_data' : plot_data,
+            'geometry_tiers' : geometry_tiers,
+            'geometry' : geometry,
+            'bounds' : part_bounds(geometry_tiers['fine']),
+            'map_cache' : map_cache,
+            'by_country' : by_country,
+            'frames' : country_frames(plot_data, geometry['country'])}
+
+
+def load_growth_data(qdb, version, cache = None):
+    """
+    Query and prepare the (read-only) data for the growth tab. The query
+    results are cached on disk (see ArtifactCache) for the next process.
+
+    Parameters:
+    qdb (queryDB): connection to the covid DB
+    version: version of the data in the DB (see DatasetStore), key of the cache
+    cache: cache to get the query results from, default artifacts
+
+    Returns:
+    dictionary with the first & last date, the bokeh data per date of the
+    top10 (top10_by_date), continent (cont_by_date) and growth (exp_by_date)
+    plots, the top-10 countries per date (factors_by_date) and the axes of
+    the growth plot (x_set, y_set, x_max, y_max) and frames (all dates, for
+    the client-side animation)
+    """
+    # dataset for barplots
+    cache = artifacts if cache is None else cache
+    bar_data = cache.get('bar_data', version, qdb.get_top10_countries)
+    bar_data['color'] = bar_data['continent'].cat.rename_categories(continent_colors)
+
+    # cached as well: per date the partitions are views on these (shared) frames
+    top10_countries = cache.get('top10_countries', version,
+                                lambda: bar_data[bar_data['conf_rnk']<=10].reset_index(drop = True))
+
+    # name-lists by date for factors on axis
+    country_range = top10_countries.groupby('date')['country'].aggregate(lambda x: list(x)).reset_index()
+
+    # prepare continent barplot
+    cont_bars = cache.get('cont_bars', version,
+                          lambda: bar_data[bar_data['plot_continent']==1].reset_index(drop = True))
+
+    # dataset for exp_plot
+    exp_data = cache.get('exp_data', version, qdb.get_exp_data)
+    exp_data['color'] = exp_data['continent'].cat.rename_categories(continent_colors)
+    exp_data = prep_exp_plot(exp_data)
+    x_set, y_set, x_max, y_max = setAxes(exp_data)
+
+    # name-lists (reversed for plotting top-down) by date for factors on axis
+    factors_by_date = {date.strftime('%Y-%m-%d') : countries[::-1]
+                       for date, countries in zip(country_range['date'], country_range['country'])}
+
+    # split by date once, slider moves are a lookup
+    return {'first_date' : top10_countries['date'].min().strftime("%Y-%m-%d"),
+            'end_date' : top10_countries['date'].max().strftime("%Y-%m-%d"),
+            'top10_by_date' : partition_by_date(top10_countries),
+            'cont_by_date' : partition_by_date(cont_bars),
+            'exp_by_date' : partition_by_date(exp_data),
+            'factors_by_date' : factors_by_date,
+            'x_set' : x_set,
+            'y_set' : y_set,
+            'x_max' : x_max,
+            'y_max' : y_max,
+            'frames' : growth_frames(top10_countries, cont_bars, exp_data, continent_colors)}
+
+
+def memory_usage(obj):
+    """
+    Memory used by (the dataframes & arrays in) an object, in bytes. Arrays
+    which are views are not counted.
+
+    Parameters:
+    obj: dataframe, series, numpy array, or a dict/list of these
+
+    Returns:
+    memory usage in bytes (int)
+    """
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep = True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep = True))
+    if isinstance(obj, np.ndarray):
+        # views (on another array or a memory-mapped file) hold no memory of their own
+        return obj.nbytes if obj.base is None else 0
+    if isinstance(obj, DateCache):
+        return memory_usage(list(obj._cache.values()))
+    if isinstance(obj, dict):
+        return sum(memory_usage(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(memory_usage(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+class DatasetStore:
+    """
+    Process-wide store of the dashboard datasets, shared (read-only) by all
+    bokeh sessions. Each dataset is loaded on first use and reloaded once
+    the data version changes (new or revised dates, i.e. by update_db).
+
+    Parameters:
+    qdb (queryDB): connection to the covid DB
+    loaders (dict): dataset name and function loading it, taking qdb, the
+                    version of the data and the cache
+    version (function): returns the current version, i.e. the version
+                        published by the loader process, default (and when
+                        it returns None) the version of the DB (db_version)
+    cache: cache the loaders get their frames from, default artifacts (the
+           on-disk cache)
+    """
+    def __init__(self, qdb, loaders, version = None, cache = None):
+        self.qdb = qdb
+        self.loaders = loaders
+        self.version = version
+        self.cache = artifacts if cache is None else cache
+        self._datasets = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+
+
+    def current_version(self):
+        """
+        Version of the data, i.e. the version published by the loader process
+        or else the version of the DB
+        """
+        if self.version is not None:
+            version = self.version()
+            if version is not None:
+                return version
+
+        return self.db_version()
+
+
+    def db_version(self):
+        """
+        Version of the data in the DB (queryDB.data_version), the last date in
+        daily_stats for a DB which isn't versioned yet
+        """
+        version = self.qdb.data_version()
+        if version is not None:
+            return version
+
+        return self.qdb.output_query("SELECT MAX(date) AS date FROM daily_stats")['date'].iloc[0]
+
+
+    def get(self, name):
+        """
+        Get a dataset, (re)loading it if not loaded for the current version.
+        The result is shared between sessions and should not be modified.
+
+        Parameters:
+        name (string): dataset to get (key in loaders)
+
+        Returns:
+        dataset as returned by its loader
+        """
+        version = self.current_version()
+
+        with self._lock:
+            if self._versions.get(name) != version:
+                with timed('load_' + name):
+                    self._datasets[name] = self.loaders[name](self.qdb, version, self.cache)
+                self._versions[name] = version
+                print('{} data loaded till {}: {:.1f} MB'.format(name, version,
+                      memory_usage(self._datasets[name]) / 1e6))
+
+            return self._datasets[name]
+
+
+    def memory_report(self):
+        """
+        Memory used by each loaded dataset (tab), per item in the dataset
+
+        Returns:
+        pandas dataframe with columns dataset, item and mb
+        """
+        with self._lock:
+            report = [(name, item, memory_usage(value) / 1e6)
+                      for name, dataset in self._datasets.items()
+                      for item, value in dataset.items()]
+
+        return pd.DataFrame(report, columns = ['dataset', 'item', 'mb'])
+
+
+    def invalidate(self):
+        """
+        Drop all loaded datasets, forcing a reload on next use
+        """
+        with self._lock:
+            self._datasets = {}
+            self._versions = {}
+
+
+    def publish(self, shared):
+        """
+        Run all loaders and publish the frames they are built from to the
+        workers (loader process of a multi-process deployment). Publishes
+        are serialized, i.e. of the refresher thread and at startup.
+
+        Parameters:
+        shared (SharedDatasets): where to publish
+
+        Returns:
+        the published version, None if it wasn't newer than the published
+        version
+        """
+        with self._publish_lock:
+            version = self.db_version()
+            recorder = shared_datasets.FrameRecorder(artifacts)
+            for load in self.loaders.values():
+                load(self.qdb, version, recorder)
+
+            with timed('publish_datasets'):
+                key = shared.publish(version, recorder.frames)
+            if key is None:
+                return None
+
+        print('datasets published for {}: {}'.format(version, ', '.join(recorder.frames)))
+        return version
+
+
+# worker of a multi-process deployment: frames & version from the loader process (memory-mapped)
+store = DatasetStore(qdb, {'country' : load_country_data,
+                           'growth' : load_growth_data},
+                     version = shared_datasets.shared.current_version if shared_datasets.enabled else None,
+                     cache = shared_datasets.shared if shared_datasets.enabled else None)
@@ -1,75 +1,65 @@
 import numpy as np
-import pandas as pd
-from datetime import date, datetime
+from datetime import datetime
 
-from src.data.process_data import update_db
-from src.visualization.prepare_dashboard_data import prep_exp_plot, setAxes
-from src.data.quick_queries import queryDB
-qdb = queryDB('sqlite','../../data/processed/covid_db.sqlite')
+from src.visualization.dashboard_data import store, continent_colors
+from src.visualization.prepare_dashboard_data import update_source
+from src.visualization.instrument import measure_patch
+from src.visualization.client_animation import add_growth_animation
+from src.metrics import timed
 
 from bokeh.io import curdoc
-from bokeh.plotting import figure, show
-from bokeh.models import ColumnDataSource, GeoJSONDataSource, NumeralTickFormatter, HoverTool, DateSlider, Button
+from bokeh.plotting import figure
+from bokeh.models import ColumnDataSource, NumeralTickFormatter, HoverTool, DateSlider, Button
 from bokeh.layouts import row, column
 
-def growth_tab():
+@timed('growth_tab')
+def growth_tab(client_animation = False):
     """
     Plots for the growth tab.
     Details behind the plots in notebook/plots/1_covid_control.ipynb
-    """
-
-    #### Get and prepare data
-    # colorscheme per continent used througout all plots
-    continent_colors = {'Africa' : '#003f5c',
-                        'Asia' : '#444e86',
-                        'Europe' : '#955196',
-                        'North America' : '#dd5182',
-                        'Oceania' : '#ff6e54',
-                        'South America' : '#ffa600'}
-
-    # dataset for barplots
-    bar_data = qdb.get_top10_countries()
-    bar_data['color'] = bar_data['continent'].replace(continent_colors)
-    top10_countries = bar_data[bar_data['conf_rnk']<=10]
-
-    # name-lists by date for factors on axis
-    country_range = top10_countries.groupby('date')['country'].aggregate(lambda x: list(x)).reset_index()
 
-    # prepare continent barplot
-    cont_bars = bar_data[bar_data['plot_continent']==1]
+    Parameters:
+    client_animation (bool): run the slider & animation in the browser on
+                             preloaded frames instead of via the server
+    """
 
-    # dataset for exp_plot
-    exp_data = qdb.get_exp_data()
-    exp_data['color'] = exp_data['continent'].replace(continent_colors)
-    exp_data = prep_exp_plot(exp_data)
-    x_set, y_set, x_max, y_max = setAxes(exp_data)
+    #### Get data, shared with other sessions (don't modify)
+    data = store.get('growth')
+    top10_by_date = data['top10_by_date']
+    cont_by_date = data['cont_by_date']
+    exp_by_date = data['exp_by_date']
+    factors_by_date = data['factors_by_date']
+    x_set, y_set, x_max, y_max = data['x_set'], data['y_set'], data['x_max'], data['y_max']
 
 
     #### starting variables
-    first_date = top10_countries['date'].min()
-    end_date = top10_countries['date'].max()
+    first_date = data['first_date']
+    end_date = data['end_date']
     start_date = first_date #'2020-03-10' #'2020-02-01'
 
 
     #### create bokeh datasources
-    top10_source = ColumnDataSource(top10_countries[top10_countries['date']==start_date])
-    cont_source = ColumnDataSource(cont_bars[cont_bars['date']==start_date])
-    exp_source = ColumnDataSource(exp_data[exp_data['date'] == start_date])
+    # copies: the sources are patched, leave the shared data untouched
+    top10_source = ColumnDataSource({col : np.array(v) for col, v in top10_by_date[start_date].items()})
+    cont_source = ColumnDataSource({col : np.array(v) for col, v in cont_by_date[start_date].items()})
+    exp_source = ColumnDataSource({col : np.array(v) for col, v in exp_by_date[start_date].items()})
 
 
     #### interactive elements
+    @timed('growth_slider')
     def update_slider(attr, old, new):
         # changes to listen for
         dt = date_slider.value
         select_date = datetime.fromtimestamp(dt/1000).strftime("%Y-%m-%d")
 
-        # update data
-        exp_source.data = exp_data[exp_data['date'] == select_date]
-        top10_source.data = top10_countries[top10_countries['date']==select_date]
-        cont_source.data = cont_bars[cont_bars['date']==select_date]
+        with measure_patch(date_slider.document, 'growth_slider'):
+            # update data (prebuilt per date), only sending the changes
+            update_source(exp_source, exp_by_date[select_date], 'country')
+            update_source(top10_source, top10_by_date[select_date], 'country')
+            update_source(cont_source, cont_by_date[select_date], 'continent')
 
-        # update categorical plot range (countries) top-10 plot
-        top10_plot.y_range.factors = country_range[country_range['date'] == select_date]['country'].iloc[0][::-1]
+            # update categorical plot range (countries) top-10 plot
+            top10_plot.y_range.factors = factors_by_date[select_date]
 
     # update slider during animation
     def animate_update():
@@ -79,9 +69,10 @@ def growth_tab():
             dt_formatted = start_date #date(2020, 3, 1).strftime("%Y-%m-%d")
         date_slider.value = datetime.strptime(dt_formatted, "%Y-%m-%d")
 
-    # run the animation
+    # run the animation (callback per session, a module global is shared by all sessions)
+    callback_id = None
     def animate():
-        global callback_id
+        nonlocal callback_id
         if button.label == '► Play':
             button.label = '❚❚ Pause'
             # second parameter is the step-time in ms
@@ -97,11 +88,14 @@ def growth_tab():
     date_slider = DateSlider(title = "Date: ", start = datetime.strptime(first_date, '%Y-%m-%d'),
                              end = slider_end, value = datetime.strptime(start_date, '%Y-%m-%d'),
                              step=1)
-    date_slider.on_change('value', update_slider)
 
     # play button - 'animate'
     button = Button(label='► Play', width=60)
-    button.on_click(animate)
+
+    # client-side the callbacks are added once the plots exist (see below)
+    if not client_animation:
+        date_slider.on_change('value', update_slider)
+        button.on_click(animate)
 
 
     #### plots
@@ -133,7 +127,7 @@ def growth_tab():
                                 ('recovered', '@recovered{,00}')]) # also add deaths, recovered
 
     top10_plot = figure(title = 'Top 10 countries with most Covid cases',
-                        y_range = country_range[country_range['date'] == start_date]['country'].iloc[0][::-1],
+                        y_range = factors_by_date[start_date],
                         plot_height=300,
                         toolbar_location = None,
                         tools=[hover])
@@ -177,6 +171,13 @@ def growth_tab():
     exp_plot.yaxis.major_label_overrides = y_set
 
 
+    #### client-side animation: all frames send once, no server round-trips
+    if client_animation:
+        add_growth_animation(data['frames'], date_slider, button,
+                             datetime.strptime(start_date, "%Y-%m-%d"), top10_source,
+                             cont_source, exp_source, top10_plot)
+
+
     #### layout
     layout = row(column(exp_plot,
                         row(date_slider, button, sizing_mode='scale_width')),
@@ -0,0 +1,65 @@
+import os
+from contextlib import contextmanager
+
+from bokeh.document.events import DocumentPatchedEvent
+from bokeh.protocol import Protocol
+
+from src import metrics
+
+# only measure when enabled, serializing the patches a second time is not free
+enabled = os.environ.get('COVID_PATCH_STATS', '0') == '1' or metrics.enabled
+
+
+def message_size(event):
+    """
+    Size of the websocket message (PATCH-DOC) bokeh sends for a document
+    change, incl. binary buffers
+
+    Parameters:
+    event (DocumentPatchedEvent): change in the document
+
+    Returns:
+    number of bytes (int)
+    """
+    msg = Protocol().create('PATCH-DOC', [event])
+    return len(msg.header_json) + len(msg.metadata_json) + len(msg.content_json) + \
+           sum(len(payload) for _, payload in msg.buffers)
+
+
+@contextmanager
+def measure_patch(doc, name):
+    """
+    Record the bytes send to the browser by the document changes within the
+    block, i.e. a slider callback, as a metric in bytes (see metrics.report).
+    Does nothing unless COVID_PATCH_STATS=1 or COVID_PROFILE=1.
+
+    Parameters:
+    doc (bokeh document): document of the session
+    name (string): name to record the bytes under
+    """
+    if not enabled or doc is None:
+        yield
+        return
+
+    sizes = []
+    def on_change(event):
+        if isinstance(event, DocumentPatchedEvent):
+            sizes.append(message_size(event))
+
+    doc.on_change(on_change)
+    try:
+        yield
+    finally:
+        doc.remove_on_change(on_change)
+        metrics.record(name, sum(sizes), 'bytes', force = True)
+
+
+def patch_report():
+    """
+    Summary of the recorded bytes per callback
+
+    Returns:
+    dictionary with per name the summary of its metric (count, mean,
+    percentiles, max & histogram, see metrics.Histogram)
+    """
+    return metrics.report('bytes').get('bytes', {})
@@ -1,9 +1,11 @@
 import numpy as np
 import pandas as pd
-import geopandas as gpd
-import json
+import threading
+from collections import OrderedDict
 from bokeh.palettes import brewer
 
+from src.metrics import timed
+
 
 def get_country_colormap(bins=9):
     """
@@ -23,94 +25,306 @@ def get_country_colormap(bins=9):
     return colormap
 
 
+def bin_country_colors(conf_group, dates):
+    """
+    Bin the (dense) rank of confirmed cases per date on 1-9 and assign a
+    color to each bin. Dates with more than 9 ranks are mapped back to 9
+    bins using percentiles of that date's ranks. Rank 1 (no population
+    data, i.e. 'totals') doesn't get a color.
+
+    Parameters:
+    conf_group (pandas series): dense rank of confirmed_scaled per date
+    dates (pandas series): date of each row in conf_group
+
+    Returns:
+    pandas series with a color per row (NaN for rank 1), same index as conf_group
+    """
+    ranks = (conf_group - 1).to_numpy() #-1 deals with the conf_group 1 for 'totals'
+    max_rank = conf_group.groupby(dates).transform('max').to_numpy() - 1
+
+    # bin edges for each distinct max_rank, only needed if we have >9 ranks
+    pcts = [0, 11, 22, 33, 44, 55, 66, 77, 88, 100]
+    edges = {m : np.percentile(np.arange(m + 1), pcts).round() for m in np.unique(max_rank) if m >= 9}
+
+    # label k if rank falls in (edge k-1, edge k], else keep the rank itself
+    labels = ranks.astype(float)
+    for m, m_edges in edges.items():
+        rows = max_rank == m
+        labels[rows] = 1 + (ranks[rows, None] > m_edges[None, 1:-1]).sum(axis = 1)
+    labels[ranks <= 0] = np.nan
+
+    # assign a color from bokeh brewer
+    palette = np.array(list(get_country_colormap().values()), dtype = object)
+    colors = np.full(len(labels), np.nan, dtype = object)
+    valid = ~np.isnan(labels)
+    colors[valid] = palette[labels[valid].astype(int) - 1]
+
+    return pd.Series(colors, index = conf_group.index)
+
+
+@timed('country_plot_data')
 def country_plot_data(df, countries):
     """
-    Get data to create a choropleth map
+    Get the per-date data to colour a choropleth map. Geometry is kept
+    separately (see load_geometry_tiers) to avoid copying it for every date.
 
     Parameters:
     df (pandas dataframe): main dataframe with covid cases per country & day
-    countries (geopandas dataframe): countries and geometry
+    countries (dict or dataframe): countries on the map (column country)
 
     Returns:
     pandas dataframe with relevant data for choropleth map
     """
     # bin country on 1-9 by confirmed_cases per day ('partition')
-    color_col = []
-    for date in list(df['date'].unique()):
-        ranks = df[df['date'] == date]['conf_group'] - 1 #-1 deals with the conf_group 1 for 'totals'
-        max_rank = ranks.max()
+    colors = bin_country_colors(df['conf_group'], df['date'])
 
-        # if we have >9 ranks, map them back to 9
-        if max_rank >= 9:
-            bins = np.percentile(np.arange(max_rank+1), [0, 11, 22, 33, 44, 55, 66, 77, 88, 100]).round()
-            ranks = pd.cut(ranks,  bins, labels = np.arange(9)+1)
+    # only keep countries we can plot (no need to keep totals here) and the
+    # relevant columns used in plot
+    cols = ['date','country','confirmed_scaled','deaths_scaled']
+    plot_data = df.loc[df['country'].isin(countries['country']), cols]
 
-        # assign a color from bokeh brewer
-        colormap = get_country_colormap()
-        color_col.append(ranks.replace(colormap))
+    # few distinct colors, store as categorical
+    plot_data['color'] = colors[plot_data.index].astype('category')
 
-        # add the color columns - ordering is safe since DF is ordered by date, country
-    df['color'] = np.array(color_col).flatten()
+    return plot_data.reset_index(drop = True)
 
-    # left merge to include 'countries' without data (i.e. Greenland)
-    # no need to keep totals here.
-    plot_data = countries.merge(df, on = 'country', how = 'left')
 
-    # plot countries where we have no data (i.e. Greenland) as grey.
-    plot_data['color'] = plot_data['color'].fillna('#d9d9d9')
+def prep_map_attributes(df, country_order, date):
+    """
+    Get the per-date columns of the choropleth map, aligned with the rows
+    of the geometry source (see load_geometry_tiers)
 
-    # select relevant columns used in plot
-    cols = ['date','country','geometry','confirmed_scaled','deaths_scaled','color']
+    Parameters:
+    df (pandas dataframe): data to be plotted for multiple days
+                           (output of country_plot_data)
+    country_order (list): countries in order of the geometry source
+    date (string): date for which to select data in df
 
-    return plot_data[cols]
+    Returns:
+    dictionary with columns color, confirmed_scaled and deaths_scaled
+    """
+    plot_day = df[df['date'] == date]
+    plot_day = plot_day.set_index(plot_day['country'].astype(str)).reindex(country_order)
 
+    # plot countries where we have no data (i.e. Greenland) as grey.
+    return {'color' : plot_day['color'].astype(object).fillna('#d9d9d9').tolist(),
+            'confirmed_scaled' : plot_day['confirmed_scaled'].to_numpy(),
+            'deaths_scaled' : plot_day['deaths_scaled'].to_numpy()}
 
-def prep_geojson(df, date):
+
+class DateCache:
     """
-    Create a geojson to serve a bokeh GeoJSONdatasource
+    Thread-safe cache of per-date payloads (i.e. map colors), build
+    lazily on first request and evicted least-recently-used.
 
     Parameters:
-    df (geopandas dataframe): data to be plotted for multiple days
-    date (string): date for which to select data in df
-
-    Returns:
-    json object (string) to serve as bokeh GeoJSONdatasource
+    builder (function): function taking a date (string) and returning the
+                        payload to be cached for that date
+    maxsize (int): maximum number of dates kept, None to keep all dates
     """
-    # also include NA (countries with no data and hence no date i.e. Greenland)
-    plot_day = df[(df['date'] == date) | (df['date'].isna())]
+    def __init__(self, builder, maxsize = None):
+        self.builder = builder
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
 
-    #Read data to json
-    merged_json = json.loads(plot_day.to_json())
+    def get(self, date):
+        """
+        Get the payload for a date, building it if not yet cached
 
-    #Convert to String like object.
-    json_data = json.dumps(merged_json)
-    return json_data
+        Parameters:
+        date (string): date for which to get the payload
 
+        Returns:
+        payload as returned by builder
+        """
+        with self._lock:
+            if date in self._cache:
+                self._cache.move_to_end(date)
+                return self._cache[date]
 
+        # build outside the lock, worst case two sessions build the same date
+        payload = self.builder(date)
+
+        with self._lock:
+            self._cache[date] = payload
+            self._cache.move_to_end(date)
+            if self.maxsize is not None:
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last = False)
+
+        return payload
+
+
+@timed('prep_exp_plot')
 def prep_exp_plot(df, main_alpha = 1.0, non_selection_alpha = 0.2):
     """
-    Convert string_agg object to an array of ints and add an alpha Column
-    for plotting bases in wether or not a country is in top-10 most cases
+    Build the growth lines: for each country & date all points up till that
+    date. Each country's series is stored once, the lines per date are
+    prefix slices (views) of that series. Also add an alpha column for
+    plotting based on whether or not a country is in top-10 most cases
 
     Parameters:
-    df (pandas dataframe): base dataframe for exponential plot
-                           (output of qdb.get_exp_data)
+    df (pandas dataframe): base dataframe for exponential plot, one row per
+                           country & date (output of qdb.get_exp_data)
     main_alpha (float): base alpha value in plot (default = 1)
     non_selection_alpha (float): alpha for values not in top-10 (default = 0.2)
 
     Returns:
     df (pandas dataframe)
     """
+    df = df.sort_values(['country','date']).reset_index(drop = True)
+
     # add alpha
     df['alpha'] = (df['conf_rnk'] <= 10) * (main_alpha - non_selection_alpha) + non_selection_alpha
 
-    # apply function to row of pandas df
-    df['confirmed'] = df['confirmed'].apply(lambda x: np.array(x.split(',')).astype(int))
-    df['new_last_week'] = df['new_last_week'].apply(lambda x: np.array(x.split(',')).astype(int))
+    # running maximum per country, used for the axes
+    df['confirmedmax'] = df.groupby('country')['confirmed'].cummax()
+    df['new_last_weekmax'] = df.groupby('country')['new_last_week'].cummax()
+
+    # first row of each country, all points up till a date are a slice from there
+    start = (df.index - df.groupby('country').cumcount()).to_numpy()
+    end = df.index.to_numpy() + 1
+
+    confirmed = df['confirmed'].to_numpy().astype(int)
+    new_last_week = df['new_last_week'].to_numpy().astype(int)
+    df['confirmed'] = [confirmed[s:e] for s, e in zip(start, end)]
+    df['new_last_week'] = [new_last_week[s:e] for s, e in zip(start, end)]
 
     return df
 
 
+def rows_index(rows):
+    """
+    Index of the rows of a group: a slice when the rows are consecutive
+    (i.e. a sorted frame), such that the partition is a view on the column
+    arrays (i.e. memory-mapped shared frames) instead of a copy
+
+    Parameters:
+    rows (numpy array): sorted row numbers of the group
+
+    Returns:
+    slice or the row numbers
+    """
+    if len(rows) > 0 and rows[-1] - rows[0] + 1 == len(rows):
+        return slice(rows[0], rows[-1] + 1)
+    return rows
+
+
+def partition_by_date(df, columns = None):
+    """
+    Split a dataframe by date into ready-to-use bokeh ColumnDataSource data,
+    such that a slider move is a dictionary lookup instead of a scan. For a
+    frame sorted by date the partitions are views, not copies.
+
+    Parameters:
+    df (pandas dataframe): data for multiple days, with a date column
+    columns (list): columns to keep, None for all columns but date
+
+    Returns:
+    dictionary with date (yyyy-mm-dd) as key and a dictionary of column
+    arrays as value
+    """
+    columns = [col for col in df.columns if col != 'date'] if columns is None else columns
+
+    # convert categoricals to arrays once, not per date
+    arrays = {col : np.asarray(df[col]) for col in columns}
+
+    partitions = {}
+    for date, rows in df.groupby('date', sort = True).indices.items():
+        index = rows_index(rows)
+        partitions[pd.Timestamp(date).strftime('%Y-%m-%d')] = {col : arrays[col][index] for col in columns}
+
+    return partitions
+
+
+def partition_by_country(df, columns = None):
+    """
+    Split a dataframe by country into ready-to-use bokeh ColumnDataSource
+    data, such that selecting a country is a dictionary lookup instead of a
+    scan. The rows of a country keep their order (i.e. by date). For a frame
+    sorted by country the partitions are views, not copies.
+
+    Parameters:
+    df (pandas dataframe): data for multiple countries, with a country column
+    columns (list): columns to keep, None for all columns but country
+
+    Returns:
+    dictionary with country as key and a dictionary of column arrays as value
+    """
+    columns = [col for col in df.columns if col != 'country'] if columns is None else columns
+    arrays = {col : np.asarray(df[col]) for col in columns}
+
+    partitions = {}
+    for country, rows in df.groupby('country', observed = True).indices.items():
+        index = rows_index(rows)
+        partitions[str(country)] = {col : arrays[col][index] for col in columns}
+
+    return partitions
+
+
+def values_changed(old, new):
+    """
+    Element-wise check which values changed, NaN is considered equal to NaN
+
+    Parameters:
+    old (numpy array): current values
+    new (numpy array): new values, same length as old
+
+    Returns:
+    boolean numpy array
+    """
+    if new.dtype == object and len(new) > 0 and isinstance(new[0], np.ndarray):
+        return np.array([len(a) != len(b) or (a != b).any() for a, b in zip(old, new)], dtype = bool)
+
+    changed = old != new
+    if old.dtype.kind == 'f' and new.dtype.kind == 'f':
+        changed &= ~(np.isnan(old) & np.isnan(new))
+
+    return np.asarray(changed, dtype = bool)
+
+
+def update_source(source, new_data, key):
+    """
+    Update a bokeh ColumnDataSource, only sending what changed to the
+    browser. If the rows (key column) are unchanged, the changed values are
+    patched, except for array-valued (i.e. multi_line) and datetime columns
+    which are replaced when changed. Otherwise all data is replaced.
+
+    new_data is copied, such that patches never modify shared data.
+
+    Parameters:
+    source (ColumnDataSource): source to update
+    new_data (dict): new columns (arrays), subset of the columns in source
+    key (string): column identifying the rows, None if the rows are fixed
+    """
+    if key is not None:
+        old_keys = np.asarray(source.data[key])
+        new_keys = np.asarray(new_data[key])
+        if len(old_keys) != len(new_keys) or (old_keys != new_keys).any():
+            source.data = {col : np.array(values) for col, values in new_data.items()}
+            return
+
+    patches, replace = {}, {}
+    for col, values in new_data.items():
+        new = np.asarray(values)
+        rows = np.flatnonzero(values_changed(np.asarray(source.data[col]), new))
+        if len(rows) == 0:
+            continue
+
+        # patch scalar values, replace arrays (multi_line) and datetimes
+        if new.dtype.kind == 'M' or (new.dtype == object and isinstance(new[0], np.ndarray)):
+            replace[col] = np.array(new)
+        else:
+            patches[col] = list(zip(rows.tolist(), new[rows].tolist()))
+
+    if len(replace) > 0:
+        source.data.update(replace)
+    if len(patches) > 0:
+        source.patch(patches)
+
+
 def setAxes(exp):
     """
     Create ticks & ticklabels for the double-log growth plot